@@ -0,0 +1,189 @@
+import gc
+import json
+import math
+import platform
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+
+from reordering import Sum, Product, Neg, Inv, Exp, Log, Fn, Var, Const
+
+# Scaling benchmarks for the algebra core. Every operation runs on seeded
+# random inputs of growing size. The best of a few timed runs and the peak
+# traced memory of one more run are recorded per size. The exponent of a
+# power-law fit over the sizes is recorded too, so quadratic regressions show
+# up even when the absolute times are noisy. Results are JSON. --baseline
+# compares against an earlier run and exits with 1 on a regression.
+
+default_mix = {Sum: 3, Product: 3, Neg: 1, Inv: 1, Exp: 1, Log: 0.5, Fn: 0.5}
+arities = {Neg: 1, Inv: 1, Fn: 1, Exp: 2, Log: 2}
+
+def random_expression(rng, size, width = 4, depth = None, mix = None, variables = 8, numbers = 0.2):
+	# about size nodes. Sums and Products take 2 to width terms, depth caps the
+	# nesting (default: none), mix weighs the node classes, and leaves are one
+	# of variables names or, with probability numbers, a Const
+	mix = mix or default_mix
+	classes = list(mix)
+	weights = list(mix.values())
+
+	results = []
+	tasks = [(size, depth)]
+	while tasks:
+		task = tasks.pop()
+		if task[0] is None:  # all children are built
+			_, cls, arity = task
+			kids = results[-arity:]
+			del results[-arity:]
+			if cls is Fn: results.append(Fn('sin', 'asin', *kids))
+			else: results.append(cls(*kids))
+			continue
+
+		budget, levels = task
+		if budget <= 1 or levels == 0:
+			if rng.random() < numbers: results.append(Const(rng.randint(1, 9)))
+			else: results.append(Var(f'x{rng.randrange(variables)}'))
+			continue
+
+		cls = rng.choices(classes, weights)[0]
+		arity = arities.get(cls) or rng.randint(2, max(2, width))
+		budget -= 1
+		arity = min(arity, budget) if cls in (Sum, Product) else arity
+		cuts = sorted(rng.sample(range(1, budget), arity - 1)) if budget > arity else list(range(1, arity))
+		budgets = [end - start for start, end in zip([0, *cuts], [*cuts, max(budget, arity)])]
+
+		tasks.append((None, cls, arity))
+		tasks.extend((kid_budget, None if levels is None else levels - 1) for kid_budget in reversed(budgets))
+
+	return results[0]
+
+def shallow_expression(rng, size):  # nesting capped at 1.5 log2(size), so no long chains of any kind
+	return random_expression(rng, size, depth=max(2, int(1.5 * math.log2(size))))
+
+def small_terms(rng, size, term_size = 8):
+	return [random_expression(rng, term_size) for _ in range(max(1, size // term_size))]
+
+# name: (prepare(rng, size) -> input, run(input)). Inputs are rebuilt for every
+# run, since simplify() and eval_consts() mark what they have already done.
+operations = {
+	'build': (lambda rng, size: (rng, size), lambda args: random_expression(*args)),  # peak is the memory of the tree itself
+	'simplify': (random_expression, lambda exp: exp.simplify()),
+	'distribute': (lambda rng, size: Product(Var('k'), Sum(*small_terms(rng, size))), lambda exp: exp.distribute()),
+	'factor': (
+		lambda rng, size: Sum(*(Product(term, Var('f')) for term in small_terms(rng, size))),
+		lambda exp: exp.factor(Var('f')),
+	),
+	'substitute': (random_expression, lambda exp: exp.substitute(Var('x0'), Sum(Var('y'), Var('z')))),
+	'eval_consts': (  # no Exp, which can overflow on random constants
+		lambda rng, size: random_expression(rng, size, mix={Sum: 3, Product: 3, Neg: 1, Inv: 1, Log: 0.5, Fn: 0.5}, numbers=0.5),
+		lambda exp: exp.eval_consts(),
+	),
+	'extract': (lambda rng, size: Sum(*small_terms(rng, size)), lambda exp: exp.extract(Var('r'), len(exp.exps) // 2)),
+	'select': (lambda rng, size: Sum(*small_terms(rng, size)), lambda exp: exp.select('t', len(exp.exps) // 2)),
+	'str': (random_expression, str),
+	# the same on shallow trees, where per-node overhead rather than depth dominates
+	'simplify_shallow': (shallow_expression, lambda exp: exp.simplify()),
+	'str_shallow': (shallow_expression, str),
+	'eq_shallow': (  # two equal trees built separately, so == walks both
+		lambda rng, size: (lambda seed: (shallow_expression(random.Random(seed), size), shallow_expression(random.Random(seed), size)))(rng.random()),
+		lambda pair: pair[0] == pair[1],
+	),
+}
+
+def measure(name, size, seed = 0, repeat = 3):  # (best seconds, peak traced bytes)
+	prepare, run = operations[name]
+	best = math.inf
+	enabled = gc.isenabled()
+	for _ in range(repeat):
+		exp = prepare(random.Random(f'{seed}/{name}/{size}'), size)
+		gc.disable()
+		try:
+			start = perf_counter()
+			run(exp)
+			best = min(best, perf_counter() - start)
+		finally:
+			if enabled: gc.enable()
+
+	exp = prepare(random.Random(f'{seed}/{name}/{size}'), size)
+	tracemalloc.start()
+	try:
+		run(exp)
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return best, peak
+
+def exponent(sizes, seconds):  # least squares slope of log(seconds) over log(size)
+	points = [(math.log(size), math.log(max(time, 1e-9))) for size, time in zip(sizes, seconds)]
+	if len(points) < 2: return None
+	mean_x = sum(x for x, _ in points) / len(points)
+	mean_y = sum(y for _, y in points) / len(points)
+	spread = sum((x - mean_x) ** 2 for x, _ in points)
+	return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread if spread else None
+
+def run_benchmarks(names = None, sizes = (1000, 4000, 16000), seed = 0, repeat = 3, progress = None):
+	results = {}
+	for name in names or operations:
+		seconds = []
+		peaks = []
+		for size in sizes:
+			time, peak = measure(name, size, seed, repeat)
+			seconds.append(time)
+			peaks.append(peak)
+			if progress is not None: print(f'{name:16} {size:8} {time * 1000:10.3f}ms {peak / 1024:10.1f}KiB', file=progress)
+		results[name] = {'sizes': list(sizes), 'seconds': seconds, 'peak_bytes': peaks, 'exponent': exponent(sizes, seconds)}
+
+	return {
+		'meta': {'seed': seed, 'repeat': repeat, 'python': platform.python_version(), 'machine': platform.machine()},
+		'results': results,
+	}
+
+def compare(current, baseline, tolerance = 0.25, exponent_tolerance = 0.15):
+	# regressions of current against baseline, as messages: a time or peak more than
+	# tolerance (relative) above the baseline at the same size, or a scaling
+	# exponent more than exponent_tolerance (absolute) above it
+	out = []
+	for name, result in current['results'].items():
+		base = baseline['results'].get(name)
+		if base is None: continue
+
+		for size, time, peak in zip(result['sizes'], result['seconds'], result['peak_bytes']):
+			if size not in base['sizes']: continue
+			i = base['sizes'].index(size)
+			if time > base['seconds'][i] * (1 + tolerance):
+				out.append(f'{name} at {size}: {time * 1000:.3f}ms, baseline {base["seconds"][i] * 1000:.3f}ms')
+			if peak > base['peak_bytes'][i] * (1 + tolerance):
+				out.append(f'{name} at {size}: peak {peak} bytes, baseline {base["peak_bytes"][i]} bytes')
+
+		if None not in (result['exponent'], base['exponent']) and result['exponent'] > base['exponent'] + exponent_tolerance:
+			out.append(f'{name}: scales as n^{result["exponent"]:.2f}, baseline n^{base["exponent"]:.2f}')
+	return out
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description='Time the algebra core over growing random inputs.')
+	parser.add_argument('operations', nargs='*', help=f'operations to run (default: all of {", ".join(operations)})')
+	parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 4000, 16000], help='input sizes, in nodes (default: 1000 4000 16000)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('-r', '--repeat', type=int, default=3, help='timed runs per size; the best counts (default: 3)')
+	parser.add_argument('-o', '--output', help='file to write the JSON results to')
+	parser.add_argument('-b', '--baseline', help='earlier JSON results to compare against')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown allowed against the baseline (default: 0.25)')
+	parser.add_argument('--exponent-tolerance', type=float, default=0.15, help='increase in the scaling exponent allowed (default: 0.15)')
+	args = parser.parse_args()
+
+	unknown = [name for name in args.operations if name not in operations]
+	if unknown: parser.error(f'unknown operations: {", ".join(unknown)}')
+
+	results = run_benchmarks(args.operations, args.sizes, args.seed, args.repeat, sys.stderr)
+	if args.output:
+		with open(args.output, 'w') as file: json.dump(results, file, indent='\t')
+	else:
+		json.dump(results, sys.stdout, indent='\t')
+		print()
+
+	if args.baseline:
+		with open(args.baseline) as file: regressions = compare(results, json.load(file), args.tolerance, args.exponent_tolerance)
+		for regression in regressions: print('regression:', regression, file=sys.stderr)
+		if regressions: sys.exit(1)
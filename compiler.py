@@ -0,0 +1,98 @@
+import math
+from fractions import Fraction
+from weakref import WeakKeyDictionary
+
+import reordering
+from reordering import Expression, Sum, Product, Neg, Inv, Exp, Log, Fn, Var, Const, eliminate_common_subexpressions, fold, is_number
+
+# Compiles an expression into one flat Python function, so repeated evaluation
+# costs a single call instead of a tree walk with isinstance dispatch per node.
+
+math_functions = {
+	'sin': math.sin, 'cos': math.cos, 'tan': math.tan,
+	'asin': math.asin, 'acos': math.acos, 'atan': math.atan,
+	'sinh': math.sinh, 'cosh': math.cosh, 'tanh': math.tanh,
+	'asinh': math.asinh, 'acosh': math.acosh, 'atanh': math.atanh,
+	'exp': math.exp, 'ln': math.log, 'sqrt': math.sqrt, 'square': lambda x: x * x, 'abs': abs,
+}
+
+max_nesting = 50  # deeper subexpressions are spilled into temporaries to stay clear of parser limits
+
+cache = WeakKeyDictionary()
+
+def free_vars(exp):  # a fold rather than walk(), so shared subtrees are only visited once
+	names = set()
+	def collect(node, kids):
+		if isinstance(node, Var) and not node.is_const(): names.add(node.name)
+
+	fold(exp, collect)
+	return sorted(names)
+
+class Code_generator:
+	def __init__(self, params, temps = ()):
+		self.params = {name: f'_v{i}' for i, name in enumerate(params)}
+		self.temps = {id(node) for node in temps}  # shared subexpressions, computed once into a temporary
+		self.namespace = {'_log': math.log}
+		self.lines = []
+
+	def temp(self, src):
+		name = f'_t{len(self.lines)}'
+		self.lines.append(f'\t{name} = {src}')
+		return name
+
+	def function(self, name):
+		fn = reordering.functions.get(name)
+		if not callable(fn): fn = math_functions.get(name)
+		if fn is None: raise KeyError(f'No function registered for {name!r}')
+		ref = f'_f_{len(self.namespace)}'
+		self.namespace[ref] = fn
+		return ref
+
+	def node(self, node, kids):  # kids are (source, nesting) pairs
+		if isinstance(node, Var):
+			if node.is_const(): return repr(float(node.name)), 0
+			if node.name not in self.params: raise KeyError(f'No parameter for {node.name!r}')
+			return self.params[node.name], 0
+		if isinstance(node, Const): return repr(float(node.value) if isinstance(node.value, Fraction) else node.value), 0
+
+		if isinstance(node, Sum):
+			kids = [kid for exp, kid in zip(node.exps, kids) if not is_number(exp, 0)]
+			src = ' + '.join(src for src, _ in kids) or '0'
+		elif isinstance(node, Product):
+			kids = [kid for exp, kid in zip(node.exps, kids) if not is_number(exp, 1)]
+			src = ' * '.join(src for src, _ in kids) or '1'
+		elif isinstance(node, Neg): src = f'-{kids[0][0]}'
+		elif isinstance(node, Inv): src = f'1 / {kids[0][0]}'
+		elif isinstance(node, Exp): src = f'{kids[0][0]} ** {kids[1][0]}'
+		elif isinstance(node, Log): src = f'_log({kids[1][0]}) / _log({kids[0][0]})'
+		elif isinstance(node, Fn): src = f'{self.function(node.name)}({kids[0][0]})'
+		else: raise TypeError(f'{type(node).__name__} is not yet implemented')
+
+		nesting = 1 + max((nesting for _, nesting in kids), default=0)
+		if nesting > max_nesting or id(node) in self.temps: return self.temp(src), 0
+		return f'({src})', nesting
+
+	def compile(self, exp):
+		src, _ = fold(exp, self.node)
+		source = '\n'.join((f'def compiled({", ".join(self.params.values())}):', *self.lines, f'\treturn {src}'))
+		exec(compile(source, '<reordering>', 'exec'), self.namespace)
+		fn = self.namespace['compiled']
+		fn.source = source
+		return fn
+
+def compile_expression(exp: Expression, params = None):
+	# returns fn(*values) with one positional parameter per free Var, in params order
+	# (sorted names by default); fn.params lists that order and fn.deduplicated
+	# how many nodes common-subexpression elimination saved
+	params = tuple(free_vars(exp) if params is None else params)
+	by_params = cache.get(exp)
+	if by_params is None: by_params = cache[exp] = {}
+	fn = by_params.get(params)
+	if fn is not None: return fn
+
+	root, temps, deduplicated = eliminate_common_subexpressions(exp.eval_consts())
+	fn = Code_generator(params, temps).compile(root)
+	fn.params = params
+	fn.deduplicated = deduplicated
+	by_params[params] = fn
+	return fn
@@ -0,0 +1,287 @@
+from collections import defaultdict
+from time import perf_counter
+
+from reordering import Expression, Sum, Product, Neg, Inv, Exp, Log, Fn, Var, Const, bounded, divide, fold, power
+
+# An e-node is (op, payload, children), where op is one of the reordering
+# classes, payload holds the non-expression arguments (Var name, Const value,
+# Fn names) and children are e-class ids. Sum and Product are binary here so
+# that commutativity/associativity can be expressed as plain rewrites;
+# they are flattened again on extraction.
+
+class E_graph:
+	def __init__(self):
+		self.parent = []
+		self.hashcons = {}
+		self.classes = defaultdict(set)
+		self.consts = {}  # class id -> constant value, if the class is known to be one
+		self.dirty = False
+
+	def find(self, cid):
+		parent = self.parent
+		root = cid
+		while parent[root] != root: root = parent[root]
+		while parent[cid] != root: parent[cid], cid = root, parent[cid]
+		return root
+
+	def canon(self, node):
+		op, payload, kids = node
+		return op, payload, tuple(map(self.find, kids))
+
+	def add_node(self, op, payload = None, kids = ()):
+		node = self.canon((op, payload, kids))
+		cid = self.hashcons.get(node)
+		if cid is not None: return self.find(cid)
+
+		cid = len(self.parent)
+		self.parent.append(cid)
+		self.hashcons[node] = cid
+		self.classes[cid].add(node)
+		if op is Const: self.consts[cid] = payload
+		self.dirty = True
+		return cid
+
+	def add(self, exp):
+		return fold(exp, self.add_folded)
+
+	def add_folded(self, exp, kids):
+		if isinstance(exp, (Sum, Product)):
+			if not kids: return self.add_node(Const, 0 if isinstance(exp, Sum) else 1)
+			cid = kids[-1]
+			for kid in reversed(kids[:-1]): cid = self.add_node(exp.__class__, None, (kid, cid))
+			return cid
+
+		if isinstance(exp, (Neg, Inv, Exp, Log)): return self.add_node(exp.__class__, None, tuple(kids))
+		if isinstance(exp, Fn): return self.add_node(Fn, (exp.name, exp.inv_name), tuple(kids))
+		if isinstance(exp, Var): return self.add_node(Var, exp.name)
+		if isinstance(exp, Const): return self.add_node(Const, exp.value)
+		raise TypeError(f'{type(exp).__name__} is not yet implemented')
+
+	def union(self, a, b):
+		a = self.find(a)
+		b = self.find(b)
+		if a == b: return a
+		if len(self.classes[a]) < len(self.classes[b]): a, b = b, a
+
+		self.parent[b] = a
+		self.classes[a] |= self.classes.pop(b)
+		if b in self.consts: self.consts.setdefault(a, self.consts.pop(b))
+		self.dirty = True
+		return a
+
+	def rebuild(self):
+		# restore congruence: nodes whose children got merged may now collide
+		while True:
+			hashcons = {}
+			merges = []
+			for node, cid in self.hashcons.items():
+				node = self.canon(node)
+				cid = self.find(cid)
+				other = hashcons.setdefault(node, cid)
+				if other != cid: merges.append((other, cid))
+
+			self.hashcons = hashcons
+			if not merges: break
+			for a, b in merges: self.union(a, b)
+
+		self.classes = defaultdict(set)
+		for node, cid in self.hashcons.items(): self.classes[cid].add(node)
+		self.consts = {self.find(cid): value for cid, value in self.consts.items()}
+
+	def nodes(self, cid, op):
+		return [node for node in self.classes[self.find(cid)] if node[0] is op]
+
+	def run(self, rules = None, *, iterations = 30, node_limit = 10000, time_limit = None):
+		if rules is None: rules = default_rules
+		deadline = None if time_limit is None else perf_counter() + time_limit
+
+		for _ in range(iterations):
+			self.dirty = False
+			matches = [
+				(cid, node, rule)
+				for cid, nodes in list(self.classes.items())
+				for node in list(nodes)
+				for rule in rules.get(node[0], ())
+			]
+			for cid, node, rule in matches:
+				for new_cid in rule(self, node):
+					self.union(cid, new_cid)
+				if len(self.hashcons) > node_limit: break
+				if deadline is not None and perf_counter() > deadline: break
+
+			self.rebuild()
+			if not self.dirty: return True  # saturated
+			if len(self.hashcons) > node_limit: break
+			if deadline is not None and perf_counter() > deadline: break
+
+		return False
+
+	def extract(self, cid, cost = None):
+		if cost is None: cost = node_count
+		best = {}
+		changed = True
+		while changed:
+			changed = False
+			for class_id, nodes in self.classes.items():
+				for node in nodes:
+					try: kid_costs = [best[self.find(kid)][0] for kid in node[2]]
+					except KeyError: continue
+					node_cost = cost(node, kid_costs)
+					if class_id not in best or node_cost < best[class_id][0]:
+						best[class_id] = node_cost, node
+						changed = True
+
+		return self.build(self.find(cid), best)
+
+	def build(self, cid, best):  # iterative, so long chains of binary nodes don't hit the recursion limit
+		root = cid
+		built = {}
+		stack = [(cid, False)]
+		while stack:
+			cid, expanded = stack.pop()
+			if cid in built: continue
+			op, payload, kids = best[cid][1]
+			kids = [self.find(kid) for kid in kids]
+			if not expanded:
+				stack.append((cid, True))
+				stack.extend((kid, False) for kid in reversed(kids) if kid not in built)
+				continue
+
+			kids = [built[kid] for kid in kids]
+			if op is Sum or op is Product:
+				out = op(*(
+					sub_exp for kid in kids
+					for sub_exp in (kid.exps if isinstance(kid, op) else (kid,))
+				))
+			elif op is Var or op is Const: out = op(payload)
+			elif op is Fn: out = Fn(*payload, *kids)
+			else: out = op(*kids)
+			built[cid] = out
+		return built[root]
+
+
+# Cost functions take (enode, child costs) and return a comparable cost
+
+def node_count(node, kid_costs):
+	return 1 + sum(kid_costs)
+
+def depth(node, kid_costs):
+	return 1 + max(kid_costs, default=0)
+
+def width(node, kid_costs):  # approximate rendered width in characters
+	op, payload, kids = node
+	if op is Var or op is Const: return len(str(payload))
+	if op is Fn: return len(payload[0]) + 2 + sum(kid_costs)
+	return {Sum: 3, Product: 1, Neg: 1, Inv: 5, Exp: 1, Log: 7}[op] + sum(kid_costs)
+
+
+# Rewrite rules: each takes (egraph, enode) and yields ids of classes equal to the node's class
+
+def const_value(g, cid):
+	return g.consts.get(g.find(cid))
+
+def comm(g, node):
+	op, _, (a, b) = node
+	yield g.add_node(op, None, (b, a))
+
+def assoc(g, node):
+	op, _, (a, bc) = node
+	for _, _, (b, c) in g.nodes(bc, op):
+		yield g.add_node(op, None, (g.add_node(op, None, (a, b)), c))
+
+def identity(g, node):  # a + 0 = a, a 1 = a, a 0 = 0
+	op, _, (a, b) = node
+	value = const_value(g, b)
+	if value is None: return
+	if op is Sum and value == 0: yield a
+	if op is Product and value == 1: yield a
+	if op is Product and value == 0: yield b
+
+def fold_consts(g, node):  # same arithmetic as eval_consts()
+	op, _, kids = node
+	values = [const_value(g, kid) for kid in kids]
+	if None in values: return
+	try:
+		if op is Sum: value = values[0] + values[1]
+		elif op is Product: value = bounded(values[0] * values[1])
+		elif op is Neg: value = -values[0]
+		elif op is Inv: value = divide(1, values[0])
+		elif op is Exp: value = power(values[0], values[1])
+		else: return
+	except (ZeroDivisionError, OverflowError): return
+	if isinstance(value, complex): return
+	yield g.add_node(Const, value)
+
+def cancel(g, node):  # a - a = 0
+	_, _, (a, b) = node
+	if any(g.find(kid) == g.find(a) for _, _, (kid,) in g.nodes(b, Neg)):
+		yield g.add_node(Const, 0)
+
+def involution(g, node):  # --a = a, (a^-1)^-1 = a
+	op, _, (a,) = node
+	for _, _, (inner,) in g.nodes(a, op): yield inner
+
+def neg_sum(g, node):  # -(a + b) = -a - b
+	_, _, (ab,) = node
+	for _, _, (a, b) in g.nodes(ab, Sum):
+		yield g.add_node(Sum, None, (g.add_node(Neg, None, (a,)), g.add_node(Neg, None, (b,))))
+
+def neg_product(g, node):  # (-a) b = -(a b)
+	_, _, (a, b) = node
+	for _, _, (inner,) in g.nodes(a, Neg):
+		yield g.add_node(Neg, None, (g.add_node(Product, None, (inner, b)),))
+
+def inv_product(g, node):  # (a b)^-1 = a^-1 b^-1
+	_, _, (ab,) = node
+	for _, _, (a, b) in g.nodes(ab, Product):
+		yield g.add_node(Product, None, (g.add_node(Inv, None, (a,)), g.add_node(Inv, None, (b,))))
+
+def inv_neg(g, node):  # (-a)^-1 = -(a^-1)
+	_, _, (a,) = node
+	for _, _, (inner,) in g.nodes(a, Neg):
+		yield g.add_node(Neg, None, (g.add_node(Inv, None, (inner,)),))
+
+def distribute(g, node):  # a (b + c) = a b + a c
+	_, _, (a, bc) = node
+	for _, _, (b, c) in g.nodes(bc, Sum):
+		yield g.add_node(Sum, None, (g.add_node(Product, None, (a, b)), g.add_node(Product, None, (a, c))))
+
+def factor(g, node):  # a b + a c = a (b + c)
+	_, _, (ab, ac) = node
+	for _, _, (a, b) in g.nodes(ab, Product):
+		for _, _, (other, c) in g.nodes(ac, Product):
+			if g.find(a) == g.find(other):
+				yield g.add_node(Product, None, (a, g.add_node(Sum, None, (b, c))))
+
+def exp_exp(g, node):  # (a^b)^c = a^(b c)
+	_, _, (ab, c) = node
+	for _, _, (a, b) in g.nodes(ab, Exp):
+		yield g.add_node(Exp, None, (a, g.add_node(Product, None, (b, c))))
+
+def log_exp(g, node):  # same folding as Log.simplify()
+	_, _, (base, arg) = node
+	for _, _, (a, b) in g.nodes(arg, Exp):
+		yield g.add_node(Product, None, (b, g.add_node(Log, None, (base, a))))
+	for _, _, (a, b) in g.nodes(base, Exp):
+		yield g.add_node(Product, None, (g.add_node(Log, None, (a, arg)), g.add_node(Inv, None, (b,))))
+
+def fn_inverse(g, node):  # f(f^-1(x)) = x
+	_, (name, inv_name), (arg,) = node
+	for _, payload, (inner,) in g.nodes(arg, Fn):
+		if payload == (inv_name, name): yield inner
+
+default_rules = {
+	Sum: (comm, assoc, identity, fold_consts, cancel, factor),
+	Product: (comm, assoc, identity, fold_consts, neg_product, distribute),
+	Neg: (involution, neg_sum, fold_consts),
+	Inv: (involution, inv_product, inv_neg, fold_consts),
+	Exp: (exp_exp, fold_consts),
+	Log: (log_exp,),
+	Fn: (fn_inverse,),
+}
+
+def optimise(exp: Expression, cost = None, **budget):
+	egraph = E_graph()
+	root = egraph.add(exp)
+	egraph.run(**budget)
+	return egraph.extract(root, cost)
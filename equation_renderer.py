@@ -529,6 +529,10 @@ class Command_processor:
 			elif command == '$': self.append(self.stack[-1].exp)
 			elif command.startswith('$'): self.append(self.stack[-int(command[1:])].exp)
 
+			elif command.startswith("'"):  # infix, e.g. 'a*(b+c)^2 - log(x)/y
+				from infix import parse
+				self.append(parse(command[1:]))
+
 			elif command.startswith('!'):
 				self.append(self.Fn(*command[1:].split(), self.pop()))
 
@@ -569,7 +573,9 @@ class Command_processor:
 				self.extend((self.pop().extract(self.pop(), index))[::-1])
 
 			else:
-				self.append(self.Var(command))
+				from reordering import literal
+				number = literal(command)
+				self.append(self.Var(command) if number is None else number)
 
 		except Exception as e:
 			print(f'Could not execute ({e.__class__.__name__})', file=out)
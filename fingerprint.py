@@ -0,0 +1,89 @@
+import math
+import zlib
+from weakref import WeakKeyDictionary
+
+from reordering import Expression, Var
+
+# Probabilistic equivalence: two expressions that agree at a batch of random
+# points are equal with high probability, whatever their structure. Every
+# variable gets its own seeded values, derived from its name only, so any two
+# expressions are sampled at the same points. A fingerprint is the tuple of
+# values rounded to a few significant digits. Equal fingerprints mean "very
+# probably equivalent", and fingerprints can be used as dict keys for dedup.
+#
+# Values are drawn from [low, high], which keeps Inv and Log away from zero and
+# negative arguments for the usual forms. Points where a value still falls
+# outside the domain (nan, or inf after a division by zero) are left out when
+# two expressions are compared, and show up as None in fingerprints.
+
+class Fingerprinter:
+	def __init__(self, points = 16, seed = 0, digits = 9, low = 0.5, high = 2.0):
+		self.points = points
+		self.seed = seed
+		self.digits = digits
+		self.low = low
+		self.high = high
+		self.samples = {}  # variable name -> its values at the points
+		self.cache = WeakKeyDictionary()  # expression -> fingerprint
+
+	def sample(self, name):
+		values = self.samples.get(name)
+		if values is None:
+			import numpy as np
+			rng = np.random.default_rng([self.seed, zlib.crc32(name.encode())])
+			values = self.samples[name] = rng.uniform(self.low, self.high, self.points)
+		return values
+
+	def values(self, exp: Expression):  # exp at every point, as a float array
+		import numpy as np
+
+		names = set()
+		seen = set()
+		stack = [exp]
+		while stack:
+			node = stack.pop()
+			if id(node) in seen: continue
+			seen.add(id(node))
+			if isinstance(node, Var) and not node.is_const(): names.add(node.name)
+			stack.extend(node._children())
+
+		with np.errstate(all='ignore'):
+			out = exp.evaluate({name: self.sample(name) for name in names})
+		return np.broadcast_to(out, (self.points,))
+
+	def fingerprint(self, exp: Expression):
+		out = self.cache.get(exp)
+		if out is None:
+			out = self.cache[exp] = tuple(
+				float(f'{value:.{self.digits}g}') if math.isfinite(value) else None
+				for value in self.values(exp).tolist()
+			)
+		return out
+
+	def equivalent(self, a: Expression, b: Expression, rtol = 1e-9, atol = 1e-12, min_points = None):
+		# True if a and b agree within tolerance wherever both are finite, and they
+		# are both finite at min_points points at least (default: half of them)
+		import numpy as np
+		a = self.values(a)
+		b = self.values(b)
+		valid = np.isfinite(a) & np.isfinite(b)
+		if valid.sum() < (self.points // 2 if min_points is None else min_points): return False
+		return bool(np.allclose(a[valid], b[valid], rtol=rtol, atol=atol))
+
+	def dedupe(self, exps):  # the first of every group of equivalent expressions, in order
+		seen = set()
+		out = []
+		for exp in exps:
+			key = self.fingerprint(exp)
+			if key in seen: continue
+			seen.add(key)
+			out.append(exp)
+		return out
+
+default = Fingerprinter()
+
+def fingerprint(exp: Expression):
+	return default.fingerprint(exp)
+
+def equivalent(a: Expression, b: Expression, **tolerance):
+	return default.equivalent(a, b, **tolerance)
@@ -0,0 +1,132 @@
+import math
+import re
+
+from reordering import Sum, Product, Neg, Inv, Exp, Log, Fn, Const, Var, literal
+
+# Infix parser, e.g. parse('a*(b+c)^2 - log(x)/y'). Operator precedence parsing
+# with explicit stacks (no recursion), so nesting depth is unbounded and the
+# cost is linear in the input. Runs of + and - (or * and /) build one flat
+# Sum (or Product); parentheses keep a nested one.
+#
+# Numbers become Consts (see set_number_mode()), as they do when typed as
+# commands. Juxtaposition multiplies ('2 x', 'a (b+c)'), and a name directly
+# followed by '(' is a call: log(x) is Log(e, x) with e as a number, not a
+# free variable, log(b, x) is Log(b, x), anything else is an Fn. Inverse names
+# are ones the evaluators know (sqrt undoes square), so solved results evaluate.
+
+token_re = re.compile(r'\s*(?:(\d+\.?\d*|\.\d+)|([^\W\d]\w*)(\()?|(\S))')
+
+inverses = {
+	'sin': 'asin', 'cos': 'acos', 'tan': 'atan',
+	'sinh': 'asinh', 'cosh': 'acosh', 'tanh': 'atanh',
+	'exp': 'ln', 'sqrt': 'square',
+}
+inverses.update({inv: name for name, inv in inverses.items()})
+
+binary = {  # operator: (precedence, right associative)
+	'+': (1, False), '-': (1, False),
+	'*': (2, False), '/': (2, False),
+	'^': (4, True),
+}
+unary_precedence = 3
+
+def finish(item):  # operands are nodes, or ('+'|'*', [terms]) chains still open for more terms
+	if isinstance(item, tuple):
+		op, terms = item
+		return Sum(*terms) if op == '+' else Product(*terms)
+	return item
+
+def apply(operands, op):
+	if op == 'neg':
+		operands.append(Neg(finish(operands.pop())))
+		return
+
+	right = finish(operands.pop())
+	left = operands.pop()
+	if op == '^':
+		operands.append(Exp(finish(left), right))
+		return
+
+	chain = '+' if op in '+-' else '*'
+	if op == '-': right = Neg(right)
+	elif op == '/': right = Inv(right)
+
+	if isinstance(left, tuple) and left[0] == chain:
+		left[1].append(right)
+		operands.append(left)
+	else:
+		operands.append((chain, [finish(left), right]))
+
+def call(name, args):
+	if name == 'log':
+		if len(args) == 1: return Log(Const(math.e), args[0])
+		if len(args) == 2: return Log(*args)
+		raise ValueError('log takes one or two arguments')
+	if len(args) != 1: raise ValueError(f'{name} takes exactly one argument')
+	return Fn(name, inverses.get(name, f'{name}^-1'), args[0])
+
+def parse(text):
+	operands = []
+	ops = []  # operators, '(' markers and ('call', name, operand count at the call) entries
+	expect_operand = True
+
+	def reduce(precedence, right_assoc = False):
+		while ops and ops[-1] in binary or ops and ops[-1] == 'neg':
+			top = ops[-1]
+			top_precedence = unary_precedence if top == 'neg' else binary[top][0]
+			if top_precedence < precedence or top_precedence == precedence and right_assoc: break
+			apply(operands, ops.pop())
+
+	for match in token_re.finditer(text):
+		number, name, paren, symbol = match.groups()
+		if number is None and name is None and symbol is None: continue  # trailing whitespace
+
+		if number is not None or name is not None or symbol == '(':
+			if not expect_operand:  # juxtaposition
+				reduce(binary['*'][0])
+				ops.append('*')
+
+			if symbol == '(': ops.append('(')
+			elif paren:
+				ops.append(('call', name, len(operands)))
+				ops.append('(')
+				expect_operand = True
+				continue
+			elif number is not None: operands.append(literal(number))
+			else: operands.append(Var(name))
+			expect_operand = symbol == '('
+			continue
+
+		if expect_operand:
+			if symbol == '-': ops.append('neg'); continue
+			if symbol == '+': continue
+			raise ValueError(f'Expected an operand at {match.start(4)}, got {symbol!r}')
+
+		if symbol in binary:
+			reduce(*binary[symbol])
+			ops.append(symbol)
+			expect_operand = True
+		elif symbol in ',)':
+			reduce(0)
+			if not ops or ops[-1] != '(': raise ValueError(f'Unmatched {symbol!r} at {match.start(4)}')
+			if symbol == ',' and not (len(ops) > 1 and isinstance(ops[-2], tuple)):
+				raise ValueError(f"Unexpected ',' outside a call at {match.start(4)}")
+			operands.append(finish(operands.pop()))
+			if symbol == ',':
+				expect_operand = True
+				continue
+
+			ops.pop()
+			if ops and isinstance(ops[-1], tuple):
+				_, fn_name, start = ops.pop()
+				args = operands[start:]
+				del operands[start:]
+				operands.append(call(fn_name, args))
+		else:
+			raise ValueError(f'Unexpected {symbol!r} at {match.start(4)}')
+
+	if expect_operand: raise ValueError('Unexpected end of expression')
+	reduce(0)
+	if ops: raise ValueError('Unmatched (')
+	if len(operands) != 1: raise ValueError(f'Expected one expression, got {len(operands)}')
+	return finish(operands.pop())
@@ -0,0 +1,78 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import reordering
+from reordering import Expression, Sum, Product, flatten, settle, simplified, simplify_sequential
+from snapshot import dumps, loads
+
+# Opt-in parallel simplify(). The outermost Sums and Products that are at
+# least threshold terms wide once flattened have their terms split into one
+# contiguous run per process. Each run travels as a snapshot (see snapshot.py),
+# is simplified in a worker, and comes back in order, so the merged node and
+# everything around it are exactly what the sequential simplify() builds.
+# Snapshots don't carry node flags, so each term's flags come back next to it
+# and the parent marks the terms again instead of simplifying them a second time.
+
+def simplify_terms(data):  # worker side: snapshot of terms in, snapshot of simplified terms and their flags out
+	terms = [simplify_sequential(term) for term in loads(data)]
+	return dumps(terms), [term._flags for term in terms]
+
+class Parallel:
+	def __init__(self, processes = None, threshold = 10000):
+		self.processes = processes or os.cpu_count() or 1
+		self.threshold = threshold
+		self.executor = ProcessPoolExecutor(self.processes)
+
+	def close(self):
+		self.executor.shutdown()
+
+	def wide_nodes(self, exp):  # (node, flattened node) for the outermost wide chains not yet simplified
+		out = []
+		seen = set()
+		stack = [exp]
+		while stack:
+			node = stack.pop()
+			if node._flags & simplified or id(node) in seen: continue
+			seen.add(id(node))
+
+			if isinstance(node, (Sum, Product)):
+				flat = flatten(node)
+				if len(flat.exps) >= self.threshold:
+					out.append((node, flat))
+					continue
+				stack.extend(flat.exps)
+			else:
+				stack.extend(node._children())
+		return out
+
+	def simplify(self, exp: Expression):
+		if exp._flags & simplified: return exp
+		wide = self.wide_nodes(exp)
+		if not wide: return simplify_sequential(exp)
+
+		runs = []  # per wide node, its terms split into contiguous runs
+		for _, flat in wide:
+			size = -(-len(flat.exps) // self.processes)
+			runs.append([flat.exps[start:start + size] for start in range(0, len(flat.exps), size)])
+
+		results = self.executor.map(simplify_terms, [dumps(run) for node_runs in runs for run in node_runs])
+
+		mapping = {}
+		for (node, flat), node_runs in zip(wide, runs):
+			terms = []
+			for _ in node_runs:
+				data, flags = next(results)
+				for term, flag in zip(loads(data), flags):
+					if flag: term._mark(flag)
+					terms.append(term)
+			out = flat._rebuild(terms)._simplify()
+			settle(out, '_simplify', simplified)
+			mapping[node] = out
+
+		if exp in mapping: return mapping[exp]
+		return simplify_sequential(exp.substitute_all(mapping))
+
+def set_parallel(processes = None, threshold = 10000):  # processes=0 switches it off again
+	if reordering.parallel is not None: reordering.parallel.close()
+	reordering.parallel = Parallel(processes, threshold) if processes != 0 else None
+	return reordering.parallel
@@ -0,0 +1,174 @@
+from functools import lru_cache
+
+from reordering import Expression, Sum, Product, Neg, Inv, Exp, Log, Fn, Var, Const, fold, literal, shared_nodes
+
+# Canonical polynomial form: a map from monomials to numeric coefficients.
+# A monomial is a tuple of (atom, exponent) pairs sorted by atom, where an
+# atom is any subtree that is not a Sum, Product, Neg or numeric constant
+# (Var, Log, Fn, non-numeric powers, inverses of sums...).
+
+expand_limit = 8  # largest integer power of a Sum that gets multiplied out
+
+def numeric(exp):
+	if isinstance(exp, Const): return exp.value
+	if isinstance(exp, Var) and exp.is_const(): return literal(exp.name).value
+	return None
+
+@lru_cache(maxsize=4096)
+def atom_key(atom):
+	return atom.__class__.__name__, repr(atom)
+
+class Polynomial:
+	__slots__ = ('terms',)
+
+	def __init__(self, terms = None):
+		self.terms = terms or {}
+
+	def __repr__(self):
+		return f'Polynomial({self.terms!r})'
+
+	def __str__(self):
+		return str(self.to_expression())
+
+	def __eq__(self, other):
+		return isinstance(other, Polynomial) and self.terms == other.terms
+
+	@classmethod
+	def constant(cls, value):
+		return cls({(): value} if value else {})
+
+	@classmethod
+	def atom(cls, exp, power = 1):
+		return cls({((exp, power),): 1})
+
+	@classmethod
+	def from_expression(cls, exp):
+		# one post-order fold over the tree. A Sum adds its terms into the largest
+		# polynomial among its kids that no other node holds, so a chain of n terms
+		# costs O(n) dict updates rather than a copy per term
+		shared = shared_nodes(exp)
+
+		def post(node, kids):
+			value = numeric(node)
+			if value is not None: return cls.constant(value)
+
+			if isinstance(node, Sum):
+				owned = [kid for sub_exp, kid in zip(node.exps, kids) if id(sub_exp) not in shared]
+				out = max(owned, key=lambda kid: len(kid.terms)) if owned else cls()
+				for kid in kids:
+					if kid is not out: out += kid
+				return out
+
+			if isinstance(node, Product):
+				out = cls.constant(1)
+				for kid in kids: out = out * kid
+				return out
+
+			if isinstance(node, Neg): return -kids[0]
+
+			if isinstance(node, Inv):
+				inner, = kids
+				if len(inner.terms) == 1: return inner ** -1
+				return cls.atom(Inv(inner.to_expression()))
+
+			if isinstance(node, Exp):
+				power = numeric(node.exp)
+				base, exp = kids
+				if power is not None:
+					if power == int(power): power = int(power)
+					if len(base.terms) <= 1 or isinstance(power, int) and 0 <= power <= expand_limit:
+						return base ** power
+					return cls.atom(base.to_expression(), power)
+				return cls.atom(Exp(base.to_expression(), exp.to_expression()))
+
+			if isinstance(node, Log):
+				base, arg = kids
+				return cls.atom(Log(base.to_expression(), arg.to_expression()))
+
+			if isinstance(node, Fn):
+				return cls.atom(Fn(node.name, node.inv_name, kids[0].to_expression()))
+
+			return cls.atom(node)
+
+		return fold(exp, post, share=shared)
+
+	def __add__(self, other):
+		out = Polynomial(dict(self.terms))
+		out += other
+		return out
+
+	def __iadd__(self, other):
+		terms = self.terms
+		for mono, coeff in other.terms.items():
+			coeff += terms.get(mono, 0)
+			if coeff: terms[mono] = coeff
+			else: terms.pop(mono, None)
+		return self
+
+	def __neg__(self):
+		return Polynomial({mono: -coeff for mono, coeff in self.terms.items()})
+
+	def __mul__(self, other):
+		out = {}
+		for mono_l, coeff_l in self.terms.items():
+			for mono_r, coeff_r in other.terms.items():
+				mono = mono_mul(mono_l, mono_r)
+				coeff = out.get(mono, 0) + coeff_l * coeff_r
+				if coeff: out[mono] = coeff
+				else: out.pop(mono, None)
+		return Polynomial(out)
+
+	def __pow__(self, power):
+		if len(self.terms) == 1:
+			(mono, coeff), = self.terms.items()
+			if coeff < 0 and not isinstance(power, int):
+				return Polynomial.atom(self.to_expression(), power)
+			if coeff in (1, -1) and isinstance(power, int): coeff = coeff ** abs(power)  # keep unit coefficients exact
+			else:
+				try: coeff = coeff ** power
+				except ZeroDivisionError: return Polynomial.atom(Inv(self.to_expression()))
+			return Polynomial({tuple((atom, exp * power) for atom, exp in mono if exp * power): coeff})
+		if not self.terms:
+			if power > 0: return Polynomial()
+			return Polynomial.atom(Inv(Const(0)), -power)
+
+		out = Polynomial.constant(1)
+		for _ in range(power): out = out * self
+		return out
+
+	def to_expression(self):
+		terms = [
+			term_expression(mono, coeff)
+			for mono, coeff in sorted(self.terms.items(), key=lambda item: mono_key(item[0]))
+		]
+		if not terms: return Const(0)
+		if len(terms) == 1: return terms[0]
+		return Sum(*terms)
+
+def mono_mul(mono_l, mono_r):
+	if not mono_l: return mono_r
+	if not mono_r: return mono_l
+	powers = dict(mono_l)
+	for atom, exp in mono_r: powers[atom] = powers.get(atom, 0) + exp
+	return tuple(sorted(((atom, exp) for atom, exp in powers.items() if exp), key=lambda pair: atom_key(pair[0])))
+
+def mono_key(mono):
+	return [(atom_key(atom), -exp) for atom, exp in mono]
+
+def term_expression(mono, coeff):
+	factors = []
+	for atom, exp in mono:
+		if exp == 1: factors.append(atom)
+		elif exp == -1: factors.append(Inv(atom))
+		elif exp < 0: factors.append(Inv(Exp(atom, Const(-exp))))
+		else: factors.append(Exp(atom, Const(exp)))
+
+	neg = coeff < 0
+	if neg: coeff = -coeff
+	if coeff != 1 or not factors: factors.insert(0, Const(coeff))
+
+	exp = factors[0] if len(factors) == 1 else Product(*factors)
+	return Neg(exp) if neg else exp
+
+def canonicalize(exp: Expression):
+	return Polynomial.from_expression(exp).to_expression()
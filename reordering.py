@@ -1,29 +1,568 @@
-from abc import ABC, abstractmethod
-
-def print_return(f):
-	def inner(*args, **kwargs):
-		# print('>>> running', f.__qualname__, 'on', *args)
-		r = f(*args, **kwargs)
-		# print('<<< returned', f.__qualname__, 'with', r)
-		return r
+import re
+import sys
+from abc import ABC, ABCMeta, abstractmethod
+from collections import OrderedDict, deque
+from fractions import Fraction
+from functools import wraps
+from io import StringIO
+from time import perf_counter
+from weakref import WeakValueDictionary
+
+# Tracing: @traced only marks a function and hands it back unchanged, so it
+# costs nothing until a Trace is entered. While one is, every marked method
+# and function is swapped for a wrapper that counts calls, cumulative and self
+# time, and the nodes fold() visits during the call. Leaving the Trace puts
+# the originals back.
+#
+#   with Trace() as trace: command_processor.run(program)
+#   trace.report()
+
+def traced(f):
+	f.traced = True
+	return f
+
+trace = None
+
+class Trace:
+	def __init__(self):
+		self.stats = {}  # qualified name -> [calls, cumulative seconds, self seconds, nodes, calls in progress]
+		self.active = []  # [stats, seconds spent in traced callees] per traced call in progress
+		self.installed = []  # (owner, name, original)
+
+	def wrap(self, f):
+		stats = self.stats.setdefault(f.__qualname__, [0, 0.0, 0.0, 0, 0])
+		active = self.active
+
+		@wraps(f)
+		def inner(*args, **kwargs):
+			stats[0] += 1
+			stats[4] += 1
+			frame = [stats, 0.0]
+			active.append(frame)
+			start = perf_counter()
+			try:
+				return f(*args, **kwargs)
+			finally:
+				elapsed = perf_counter() - start
+				active.pop()
+				stats[4] -= 1
+				if not stats[4]: stats[1] += elapsed  # recursive calls are already inside the outer one
+				stats[2] += elapsed - frame[1]
+				if active: active[-1][1] += elapsed
+		return inner
+
+	def fold(self, exp, post, *args, **kwargs):  # stands in for fold() to count nodes
+		active = self.active
+		def counted(node, kids):
+			if active: active[-1][0][3] += 1
+			return post(node, kids)
+		return self.original_fold(exp, counted, *args, **kwargs)
+
+	def __enter__(self):
+		global trace
+		if trace is not None: raise RuntimeError('Another Trace is active')
+		module = sys.modules[__name__]
+		owners = [module, Command_processor, Persistent_stack]
+		classes = [Expression]
+		while classes:
+			cls = classes.pop()
+			owners.append(cls)
+			classes.extend(cls.__subclasses__())
+
+		for owner in owners:
+			for name, attr in list(vars(owner).items()):
+				if getattr(attr, 'traced', False):
+					self.installed.append((owner, name, attr))
+					setattr(owner, name, self.wrap(attr))
+
+		self.original_fold = module.fold
+		self.installed.append((module, 'fold', module.fold))
+		module.fold = self.fold
+		trace = self
+		return self
+
+	def __exit__(self, *exc_info):
+		global trace
+		for owner, name, original in reversed(self.installed): setattr(owner, name, original)
+		self.installed.clear()
+		trace = None
+
+	def as_dict(self):
+		return {
+			name: {'calls': calls, 'cumulative': cumulative, 'self': self_time, 'nodes': nodes}
+			for name, (calls, cumulative, self_time, nodes, _) in self.stats.items() if calls
+		}
+
+	def report(self, file = None, sort = 'cumulative'):
+		rows = sorted(self.as_dict().items(), key=lambda row: row[1][sort], reverse=True)
+		print(f'{"calls":>10} {"cumulative":>12} {"self":>12} {"nodes":>10}  name', file=file)
+		for name, row in rows:
+			print(f'{row["calls"]:10} {row["cumulative"]:11.6f}s {row["self"]:11.6f}s {row["nodes"]:10}  {name}', file=file)
+
+# Opt-in memo for simplify(), eval_consts() and distribute(), keyed on
+# (method, node). Node hashes are structural, so an unchanged subtree hits
+# the cache no matter which stack entry it hangs off.
+class Memo:
+	def __init__(self, maxsize = 65536):
+		self.maxsize = maxsize
+		self.table = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def __repr__(self):
+		return f'Memo(size={len(self.table)}/{self.maxsize}, hits={self.hits}, misses={self.misses})'
+
+	def get(self, key):
+		# entries keep the key they were stored under, so only the lookup compares a
+		# fresh tree with it and moving the entry to the end matches it by identity
+		table = self.table
+		entry = table.get(key)
+		if entry is None: return None
+		self.hits += 1
+		stored, out = entry
+		table.move_to_end(stored)
+		return out
+
+	def put(self, key, value):
+		self.misses += 1
+		table = self.table
+		table[key] = key, value
+		if len(table) > self.maxsize: table.popitem(last=False)  # least recently used
+
+	def clear(self):
+		self.table.clear()
+		self.hits = self.misses = 0
+
+memo = None
+
+def set_memo(maxsize = 65536):  # a falsy maxsize disables the memo
+	global memo
+	memo = Memo(maxsize) if maxsize else None
+	return memo
+
+def memoized(f):
+	name = f.__name__
+	@wraps(f)
+	def inner(self):
+		if memo is None: return f(self)
+
+		key = name, self
+		out = memo.get(key)
+		if out is None:
+			out = f(self)
+			memo.put(key, out)
+		return out
 	return inner
 
-class Expression(ABC):
-	def __init__(self, exp = None):
-		super().__init__()
-		self.exp = exp
-	
-	def __contains__(self, exp):
-		return exp == self.exp or exp in self.exp
+# Traversals use an explicit stack instead of Python recursion, so trees built
+# from thousands of chained commands neither hit the recursion limit nor pay
+# a call frame per level.
+
+def walk(exp):  # pre-order
+	stack = [exp]
+	while stack:
+		node = stack.pop()
+		yield node
+		stack.extend(reversed(node._children()))
+
+def fold(exp, post, pre = None, enter = None, share = True):
+	# post-order: post(node, folded_children) is called once every child is done.
+	# pre(node) may return a finished result to skip the subtree; None descends.
+	# enter(node) may swap a node for an equivalent one before its children are visited.
+	# With share, a subtree reachable through several parents is only folded once.
+	# share may also be a set of node ids (see shared_nodes()) to limit what is kept,
+	# or False when results are large and not worth keeping (e.g. strings).
+	keep_all = share is True
+	done = {}
+	results = []
+	stack = [(exp, exp, None)]  # (node as reached, node after enter(), its children once expanded)
+	while stack:
+		key, node, kids = stack.pop()
+		if kids is not None:
+			out = post(node, results[-len(kids):])
+			del results[-len(kids):]
+		else:
+			if done and id(node) in done:
+				results.append(done[id(node)])
+				continue
+			if pre is not None:
+				out = pre(node)
+				if out is not None:
+					results.append(out)
+					continue
+
+			if enter is not None: node = enter(node)
+			kids = node._children()
+			if kids:  # leaves are folded right away instead of going round the stack again
+				stack.append((key, node, kids))
+				stack.extend([(kid, kid, None) for kid in reversed(kids)])
+				continue
+			out = post(node, ())
+
+		if keep_all or share and id(key) in share: done[id(key)] = out
+		results.append(out)
+
+	return results[0]
+
+def shared_nodes(exp):  # ids of inner nodes reachable through more than one parent
+	seen = set()
+	shared = set()
+	stack = [exp]
+	while stack:
+		node = stack.pop()
+		kids = node._children()
+		if not kids: continue
+		if id(node) in seen:
+			shared.add(id(node))
+			continue
+		seen.add(id(node))
+		stack.extend(kids)
+	return shared
+
+@traced
+def eliminate_common_subexpressions(exp):
+	# returns (root, temps, deduplicated): root is the same expression with every set of
+	# equal subtrees merged into one shared object, temps are the shared inner nodes in
+	# evaluation order, deduplicated is how many tree nodes the merge saved
+	canon = {}
+	def post(node, kids):
+		node = node._rebuild(kids)
+		return canon.setdefault(node, node)
+
+	root = fold(exp, post)
+	size = fold(exp, lambda node, kids: 1 + sum(kids))
+
+	shared = shared_nodes(root)
+	temps = []
+	def collect(node, kids):
+		if id(node) in shared: temps.append(node)
+		return node
+
+	fold(root, collect)
+	return root, temps, size - len(canon)
+
+@traced
+def flatten(exp):
+	# collapse a chain of nested Sums (or Products) in one pass into a Chain holding the
+	# plain terms of every level, in order, and the shape of the chain around them
+	cls = exp.__class__
+	if not any(isinstance(kid, cls) for kid in exp.exps): return exp
+
+	terms = []
+	layout = []  # per chain node, children first: its kids as term indices, or ~j for the node at layout[j]
+	frames = [[exp, 0, []]]  # node, next kid, items so far
+	while frames:
+		frame = frames[-1]
+		node, i, items = frame
+		if i == len(node.exps):
+			frames.pop()
+			layout.append(tuple(items))
+			if frames: frames[-1][2].append(~(len(layout) - 1))
+			continue
+
+		frame[1] += 1
+		kid = node.exps[i]
+		if isinstance(kid, cls):
+			frames.append([kid, 0, []])
+		else:
+			items.append(len(terms))
+			terms.append(kid)
+	return Chain(cls, tuple(layout), *terms)
+
+def flatten_chain(node):  # transform() enter hook for simplify()
+	return flatten(node) if isinstance(node, (Sum, Product)) else node
 
+class Run:  # a simplified Sum or Product (negated if neg) that is still being extended in place
+	__slots__ = ('cls', 'exps', 'neg', 'boxed', 'settled')
+
+	def __init__(self, cls, exps, neg = False):
+		self.cls = cls
+		self.exps = exps
+		self.neg = neg
+		self.boxed = 0  # the first `boxed` exps sit in a Product of their own, see join_products()
+		self.settled = False  # simplifying the node again would only flatten that Product
+
+	def node(self):
+		exps = self.exps
+		if self.boxed: exps = (Product(*exps[:self.boxed]), *exps[self.boxed:])
+		out = self.cls(*exps)
+		return Neg(out) if self.neg else out
+
+def join_sums(kids):
+	# Sum._simplify() over kids, where a Run stands for the Sum it will become.
+	# The first Sum among the kids is extended in place instead of copied
+	out = None
+	rest = []
+	for kid in kids:
+		if not isinstance(kid, (Run, Sum)):
+			if not is_number(kid, 0): rest.append(kid)
+		elif out is None:
+			out = kid if isinstance(kid, Run) else Run(Sum, list(kid.exps))
+		else:
+			out.exps.extend(kid.exps)
+
+	if out is None: return Sum(*rest)._simplify()
+	out.exps.extend(rest)
+	return out
+
+def join_products(kids):
+	# Product._simplify() over kids, where a Run stands for the Product (or Neg of one) it will
+	# become. A Run with only plain factors (or Negs of them) beside it is extended in place.
+	# The rule simplifies a negated result again, which flattens it, so that needs settled
+	# factors. When two Negs cancel it does not, and a negated Run in front is kept as a
+	# Product of its own. Anything else goes through Product._simplify() itself
+	runs = [kid for kid in kids if isinstance(kid, Run)]
+	if len(runs) == 1:
+		out, = runs
+		kids = [kid for kid in kids if not is_number(kid, 1)]
+		rest = [kid.exp if isinstance(kid, Neg) else kid for kid in kids if kid is not out]
+		neg = out.neg != (sum(isinstance(kid, Neg) for kid in kids) % 2 == 1)
+		if not any(isinstance(kid, (Product, Neg)) or is_number(kid, 0) for kid in rest):
+			settled = out.settled and all(kid._flags & simplified and not is_number(kid, 1) for kid in rest)
+			if out.neg and not neg and kids[0] is out:
+				out.boxed = len(out.exps)
+			elif neg and settled:
+				out.boxed = 0
+			elif neg or out.neg:
+				rest = None
+
+			if rest is not None:
+				out.exps.extend(rest)
+				out.neg = neg
+				out.settled = settled
+				return out
+
+	out = Product(*(kid.node() if isinstance(kid, Run) else kid for kid in kids))._simplify()
+	inner = out.exp if isinstance(out, Neg) else out
+	if isinstance(inner, Product) and not any(isinstance(exp, Neg) or is_number(exp, 0) for exp in inner.exps):
+		run = Run(Product, list(inner.exps), inner is not out)
+		run.settled = all(exp._flags & simplified and not isinstance(exp, Product) and not is_number(exp, 1) for exp in inner.exps)
+		return run
+	return out
+
+# Node flags: a transform marks the nodes it produces that a second run would leave
+# unchanged (see settle()), and later runs skip marked subtrees. Trees derived from
+# a marked one (select, extract, substitute...) share their untouched subtrees with
+# it, so only the edited spine is visited again.
+simplified = 1
+consts_evaluated = 2
+
+@traced
+def transform(exp, rule, flag = 0, enter = None):
+	# rebuild the tree bottom-up, applying a node-level rule (e.g. Sum._simplify)
+	# to each node once its children have been transformed
+	name = rule.__name__
+
+	# the memo skips leaves, which cost less to redo than to look up, and keys a node
+	# that enter() swapped (a Sum for its Chain) on the node it was given
+	entered = {}
+
+	def post(node, kids):
+		rebuilt = node._rebuild(kids)
+		out = getattr(rebuilt, name)()
+		if flag: settle(out, name, flag, out is rebuilt)
+		if memo is not None and kids: memo.put((name, entered.pop(id(node), node)), out)
+		return out
+
+	def pre(node):
+		if node._flags & flag: return node
+		if memo is not None and node._children(): return memo.get((name, node))
+
+	def enter_keyed(node):
+		out = enter(node)
+		if out is not node: entered[id(out)] = node
+		return out
+
+	return fold(exp, post, pre, enter if enter is None or memo is None else enter_keyed)
+
+def settle(exp, name, flag, unchanged = False):
+	# mark exp only once another run would leave it as it is: its children are marked and
+	# the rule gives it back unchanged. Rules are not idempotent everywhere (Product(-0, -z)
+	# becomes Product(0, z) and only then 0), so an unsettled result is visited again next time.
+	# unchanged says the rule just gave exp back as it was, so it needn't run again
+	if exp._flags & flag: return
+	for kid in exp._children():
+		if not kid._flags & flag: return
+	if unchanged or getattr(exp, name)() == exp: exp._mark(flag)
+
+parallel = None  # a parallel.Parallel that simplify() hands wide trees to, see parallel.set_parallel()
+
+def simplify_sequential(exp):
+	# simplify() without handing off to parallel. Rules that build new nodes (Neg of a Sum,
+	# Product of Negs, Inv of a Product) simplify them with this, the same way simplify()
+	# treats any other tree, so the result does not depend on how the tree was reached
+	return transform(exp, Expression._simplify, simplified, flatten_chain)
+
+# Vectorised evaluation: Fn names map to numpy ufuncs (by attribute name, so numpy
+# is only imported when evaluate() is actually used) or to registered callables
+functions = {
+	'sin': 'sin', 'cos': 'cos', 'tan': 'tan',
+	'asin': 'arcsin', 'acos': 'arccos', 'atan': 'arctan',
+	'sinh': 'sinh', 'cosh': 'cosh', 'tanh': 'tanh',
+	'asinh': 'arcsinh', 'acosh': 'arccosh', 'atanh': 'arctanh',
+	'exp': 'exp', 'ln': 'log', 'sqrt': 'sqrt', 'square': 'square', 'abs': 'absolute',
+}
+
+def register_function(name, fn):
+	functions[name] = fn
+
+# Interning mode: while enabled, nodes are built through a weak-valued table
+# so structurally identical subtrees are the same object across the stack.
+interning = False
+intern_table = WeakValueDictionary()
+
+def set_interning(enabled = True):
+	global interning
+	previous, interning = interning, enabled
+	return previous
+
+def intern_key(cls, args):
+	# children are keyed by identity (they are interned themselves),
+	# names and values by type and value so that Const(0) and Const(0.0) stay apart
+	return (cls, *(id(arg) if isinstance(arg, Expression) else (arg.__class__, arg) for arg in args))
+
+# Variable signatures: every node keeps a 64 bit filter of the Var names below
+# it, so a subtree whose signature lacks a bit of the one searched for cannot
+# contain it. The first 64 names get a bit each; later ones share bits by their
+# hash and are not stored, so a long-running process (server.py) doesn't keep
+# every name it ever saw. A name's bit never changes once it is handed out.
+var_bits = {}
+
+def var_bit(name):
+	bit = var_bits.get(name)
+	if bit is None:
+		if len(var_bits) < 64: bit = var_bits[name] = 1 << len(var_bits)
+		else: bit = 1 << (hash(name) & 63)
+	return bit
+
+class Node_type(ABCMeta):
+	# nothing registers virtual subclasses, so type's own checks (in C) answer isinstance()
+	# and issubclass() without a trip through ABCMeta's Python-level cache on every node
+	__instancecheck__ = type.__instancecheck__
+	__subclasscheck__ = type.__subclasscheck__
+
+	def __call__(cls, *args):
+		if interning:
+			key = intern_key(cls, args)
+			node = intern_table.get(key)
+			if node is not None: return node
+
+		node = super().__call__(*args)
+		object.__setattr__(node, '_hash', None)  # filled in by the first hash(), see Expression.__hash__
+		object.__setattr__(node, '_flags', 0)
+		object.__setattr__(node, '_vars', node._signature())
+
+		if interning: intern_table[key] = node
+		return node
+
+class Expression(ABC, metaclass=Node_type):
+	# Nodes are slotted: no per-instance __dict__, only the fields each class declares
+	# plus the hash once computed, the transform flags, the variable signature and a
+	# weakref slot for the intern table
+	__slots__ = ('_hash', '_flags', '_vars', '__weakref__')
+
+	def _args(self):  # constructor arguments, in order
+		return (self.exp,)
+
+	def _children(self):  # sub-expressions, in order
+		return (self.exp,)
+
+	def _signature(self):  # the children's signatures combined, sharing one of their ints where possible
+		out = 0
+		for kid in self._children():
+			if kid._vars & ~out: out = out | kid._vars if out else kid._vars
+		return out
+
+	def _rebuild(self, kids):  # same node with new children, or self if nothing changed
+		for old, new in zip(self._children(), kids):
+			if old is not new: return self.__class__(*kids)
+		return self
+
+	def __setattr__(self, name, value):
+		if hasattr(self, '_hash'): raise AttributeError(f'{self.__class__.__name__} nodes are immutable')
+		object.__setattr__(self, name, value)
+
+	def __delattr__(self, name):
+		raise AttributeError(f'{self.__class__.__name__} nodes are immutable')
+
+	def __reduce__(self):  # pickle and copy rebuild through the constructor, like any other node
+		return self.__class__, self._args()
+
+	def _mark(self, flag):  # flags describe the structure, not the object, so they can be set after construction
+		object.__setattr__(self, '_flags', self._flags | flag)
+
+	@traced
+	def __contains__(self, exp):
+		need = exp._vars
+		stack = list(self._children())
+		while stack:
+			node = stack.pop()
+			if node._vars & need != need: continue
+			if exp == node: return True
+			stack.extend(node._children())
+		return False
+
+	@traced
 	def __repr__(self):
-		return f'{self.__class__.__name__}({", ".join(f"{v!r}" for k, v in self.__dict__.items())})'
+		return fold(self, lambda node, kids: node._repr(kids), share=False)
+
+	def _repr(self, kids):
+		kids = iter(kids)
+		args = (next(kids) if isinstance(arg, Expression) else repr(arg) for arg in self._args())
+		return f'{self.__class__.__name__}({", ".join(args)})'
 
+	@traced
 	def __str__(self):
-		return f'{self.__class__.__name__}({", ".join(map(str, self.__dict__.values()))})'
+		return fold(self, lambda node, kids: node._str(kids), share=False)
+
+	def _str(self, kids):  # __str__ given the strings of the children
+		return f'{self.__class__.__name__}({", ".join(kids)})'
 
 	def __eq__(self, other):
-		return self.__class__ == other.__class__ and self.__dict__ == other.__dict__
+		# structural. Names and values compare by type as well, as in intern_key(), so
+		# Const(0) != Const(0.0). Pairs already compared are skipped, so two equal DAGs
+		# that share subtrees differently are walked once per distinct pair, not per path
+		if self is other: return True
+		if self.__class__ is not other.__class__: return False
+		if self._hash is not None and other._hash is not None and self._hash != other._hash: return False
+
+		seen = set()
+		stack = [(self, other)]
+		while stack:
+			left, right = stack.pop()
+			l_args, r_args = left._args(), right._args()
+			if len(l_args) != len(r_args): return False
+			for l_arg, r_arg in zip(l_args, r_args):
+				if l_arg is r_arg: continue
+				cls = l_arg.__class__
+				if cls is not r_arg.__class__: return False
+				if cls in leaf_types:  # compared here rather than pushed and remembered
+					l_arg, r_arg = l_arg._args()[0], r_arg._args()[0]
+					if l_arg.__class__ is not r_arg.__class__ or l_arg != r_arg: return False
+				elif isinstance(l_arg, Expression):
+					if l_arg._hash is not None and r_arg._hash is not None and l_arg._hash != r_arg._hash: return False
+					pair = id(l_arg), id(r_arg)
+					if pair in seen: continue
+					seen.add(pair)
+					stack.append((l_arg, r_arg))
+				elif l_arg != r_arg: return False
+		return True
+
+	def __hash__(self):
+		# structural, computed on first use and kept. Trees that are never used as keys
+		# don't pay for an int per node, and the children of a node being hashed are done
+		# first on an explicit stack, so hashing a deep tree cannot recurse
+		if self._hash is not None: return self._hash
+		stack = [self]
+		while stack:
+			node = stack[-1]
+			missing = [kid for kid in node._children() if kid._hash is None]
+			if missing:
+				stack.extend(missing)
+				continue
+			stack.pop()
+			if node._hash is None: object.__setattr__(node, '_hash', hash((node.__class__, node._args())))
+		return self._hash
 
 	def __neg__(self):
 		return Neg(self)
@@ -49,52 +588,120 @@ class Expression(ABC):
 	def distribute(self):
 		return self
 
-	@print_return
+	@traced
+	def simplify(self):
+		if parallel is not None: return parallel.simplify(self)
+		return simplify_sequential(self)
+
+	def _simplify(self):  # simplify this node, assuming its children are already simplified
+		return self
+
+	@traced
 	def eval_consts(self):
+		return transform(self, Expression._eval_consts, consts_evaluated)
+
+	def _eval_consts(self):  # eval_consts() for this node, assuming its children are already evaluated
 		return self
 
-	# @abstractmethod
-	# def solve_for(self, var, *, rhs):
-	# 	...
+	@traced
+	def substitute(self, find_exp, sub_exp):
+		return self.substitute_all({find_exp: sub_exp})
+
+	@traced
+	def substitute_all(self, mapping):
+		# replace every sub-expression that is a key of mapping, in one pass. Replacements
+		# are not searched again, and untouched subtrees come back as the same objects
+		if not mapping: return self
+		needs = {find._vars for find in mapping}
+		# one test rejects most of the tree: a node with none of the bits the keys need holds
+		# no key. A key without Vars (a Const) can be under any node, and then it is skipped
+		wanted = 0
+		for need in needs: wanted |= need
+		masked = 0 not in needs
+
+		def pre(node):
+			if masked and not node._vars & wanted: return node
+			if not any(node._vars & need == need for need in needs): return node  # nothing to find below
+			if node is not self: return mapping.get(node)
+
+		return fold(self, lambda node, kids: node._rebuild(kids), pre)
+
+	@traced
+	def evaluate(self, bindings, dtype = float, cse = False):
+		# bindings maps Var names to scalars or numpy arrays; the result broadcasts like numpy does.
+		# With cse, repeated subexpressions are merged first and computed once.
+		import numpy as np
+		dtype = np.dtype(dtype)
+		exp = eliminate_common_subexpressions(self)[0] if cse else self
+		return fold(exp, lambda node, kids: node._evaluate(kids, np, bindings, dtype), share=shared_nodes(exp))
+
+	def _evaluate(self, kids, np, bindings, dtype):
+		raise TypeError(f'{self.__class__.__name__} cannot be evaluated')
+
+	@traced
+	def solve_for(self, var, *, rhs):
+		# solves self = rhs for var, which must occur exactly once. One counting pass
+		# finds the path down to it, then each node on the path is peeled off with
+		# extract(), so the cost is linear in the tree
+		counts = {}  # id(node) -> occurrences of var below it
+
+		def count(node, kids):
+			counts[id(node)] = out = 1 if node == var else sum(kids)
+			return out
+
+		need = var._vars
+		total = fold(self, count, lambda node: 0 if node._vars & need != need else None)
+		if total == 0: raise ValueError(f'{var} does not occur in the expression')
+		if total > 1: raise ValueError(f'{var} occurs {total} times. Can only solve for a single occurrence')
+
+		exp = self
+		while exp != var:
+			index = next(i for i, kid in enumerate(exp._children()) if counts.get(id(kid)))
+			exp, rhs = exp.extract(rhs, index)
+		return rhs
 
 class Sum(Expression):
+	__slots__ = ('exps',)
+
 	def __init__(self, *exps):
-		super().__init__()
 		self.exps = exps
 
-	def __contains__(self, exp):
-		return exp in self.exps or any(exp in sub_exp for sub_exp in self.exps)
+	def _args(self):
+		return self.exps
 
-	def __str__(self):
+	def _children(self):
+		return self.exps
+
+	def _str(self, kids):
 		out = ' '.join(
 			f'- {exp[1:]}' if exp.startswith('-') else f'+ {exp}'
-			for exp in (f'({exp})' if isinstance(exp, Sum) else f'{exp}' for exp in self.exps)
+			for exp in (f'({kid})' if isinstance(exp, Sum) else kid for exp, kid in zip(self.exps, kids))
 		)
 		return out.removeprefix('+ ')
 
-	@print_return
+	@traced
 	def extract(self, rhs, index):
 		if isinstance(index, slice):
 			return Sum(*self.exps[index]), Sum(rhs, Neg(Sum(*self.exps[:index.start or 0], *self.exps[index.stop:])))
 		if isinstance(index, int):
 			return self.exps[index], Sum(rhs, Neg(Sum(*self.exps[:index], *self.exps[index+1:])))
-		print(index, 'is not an int or a slice')
 		raise TypeError(f'{index!r} is not an int or a slice')
 
-	@print_return
+	@traced
 	def select(self, name, index):
 		if isinstance(index, slice):
 			return Sum(*self.exps[index]), Sum(*self.exps[:index.start or 0], Var(name), *self.exps[index.stop:])
 		if isinstance(index, int):
 			return self.exps[index], Sum(*self.exps[:index], Var(name), *self.exps[index+1:])
-		print(index, 'is not an int or a slice')
 		raise TypeError(f'{index!r} is not an int or a slice')
 
-	@print_return
-	def simplify(self):
-		exps = [exp.simplify() for exp in self.exps if exp not in (Const(0), Var('0'), Var('0.0'))]
-		# print('Simplified sum', self)
-		# print('to            ', Sum(*exps))
+	def _simplify(self):
+		if len(self.exps) > 1:
+			for exp in self.exps:
+				if isinstance(exp, Sum) or is_number(exp, 0): break
+			else: return self  # nothing to flatten or drop, so no new node
+
+		exps = [exp for exp in self.exps if not is_number(exp, 0)]
 
 		sums = (sub_exp for exp in exps if isinstance(exp, Sum) for sub_exp in exp.exps)
 		not_sums = (exp for exp in exps if not isinstance(exp, Sum))
@@ -107,6 +714,7 @@ class Sum(Expression):
 
 		return Sum(*exps)
 
+	@traced
 	def factor(self, fac_exp):
 		fac_exps = []
 		for sum_exp in self.exps:
@@ -117,7 +725,6 @@ class Sum(Expression):
 				neg = False
 
 			if isinstance(sum_exp, Product):
-				# print('finding', fac_exp, 'in', sum_exp)
 				i = sum_exp.exps.index(fac_exp)
 				# TODO: rewrite using .select()
 				_, exp = sum_exp.extract(Const(1), i)
@@ -133,111 +740,114 @@ class Sum(Expression):
 
 		return Sum(*fac_exps) * fac_exp
 
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		return Sum(*(sub_exp if exp == find_exp else exp.substitute(find_exp, sub_exp) for exp in self.exps))
-
-	@print_return
-	def eval_consts(self):
-		exps = [exp.eval_consts() for exp in self.exps]
+	def _eval_consts(self):
 		const = 0
 		out_exps = []
-		for exp in exps:
-			if isinstance(exp, Var) and exp.is_const():
-				const += float(exp.name)
-			elif isinstance(exp, Const):
+		for exp in self.exps:
+			if isinstance(exp, Const):
 				const += exp.value
 			else:
 				out_exps.append(exp)
 
 		if not out_exps:
 			return Const(const)
-		print('Evaluating constants for', self, '->', const, *out_exps)
 		return Sum(Const(const), *out_exps)
 
+	def _evaluate(self, kids, np, bindings, dtype):
+		out = np.zeros((), dtype)
+		for kid in kids: out = np.add(out, kid, dtype=dtype)
+		return out
+
 class Neg(Expression):
-	def __str__(self):
+	__slots__ = ('exp',)
+
+	def __init__(self, exp):
+		self.exp = exp
+
+	def _str(self, kids):
 		if isinstance(self.exp, Sum):
-			return f'-({self.exp!s})'
-		return f'-{self.exp!s}'
+			return f'-({kids[0]})'
+		return f'-{kids[0]}'
 
-	@print_return
+	@traced
 	def extract(self, rhs, index = 0):
 		if index != 0: raise IndexError('Neg only takes index 0')
 		return self.exp, Neg(rhs)
 
-	@print_return
+	@traced
 	def select(self, name, index = 0):
 		if index != 0: raise IndexError('Neg only takes index 0')
 		return self.exp, Neg(Var(name))
 
-	@print_return
-	def simplify(self):
-
-		exp = self.exp.simplify()
+	def _simplify(self):
+		exp = self.exp
 		if isinstance(exp, Neg): return exp.exp
 		if isinstance(exp, Sum):
-			return Sum(*(Neg(exp) for exp in exp.exps)).simplify()
+			return simplify_sequential(Sum(*(Neg(exp) for exp in exp.exps)))
 
-		return Neg(exp)
+		return self
 
+	@traced
+	@memoized
 	def distribute(self):
 		return Neg(self.exp.distribute())
 
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		if self.exp == find_exp: return Neg(sub_exp)
-		return Neg(self.exp.substitute(find_exp, sub_exp))
+	def _evaluate(self, kids, np, bindings, dtype):
+		return np.negative(kids[0], dtype=dtype)
 
-	@print_return
-	def eval_consts(self):
-		post_const = self.exp.eval_consts()
-		if isinstance(post_const, Var) and post_const.is_const():
-			return Const(-float(post_const.name))
+	def _eval_consts(self):
+		post_const = self.exp
 		if isinstance(post_const, Const):
 			return Const(-post_const.value)
 
-		return Neg(post_const)
+		return self
 
 
 class Product(Expression):
+	__slots__ = ('exps',)
+
 	def __init__(self, *exps):
-		super().__init__()
 		self.exps = exps
 
-	def __contains__(self, exp):
-		return exp in self.exps or any(exp in sub_exp for sub_exp in self.exps)
+	def _args(self):
+		return self.exps
 
-	def __str__(self):
-		return ' '.join(f'({exp})' if isinstance(exp, (Product, Sum, Neg)) else f'{exp}' for exp in self.exps)
+	def _children(self):
+		return self.exps
 
-	@print_return
+	def _str(self, kids):
+		return ' '.join(f'({kid})' if isinstance(exp, (Product, Sum, Neg)) else kid for exp, kid in zip(self.exps, kids))
+
+	@traced
 	def extract(self, rhs, index):
 		return self.exps[index], Product(rhs, Inv(Product(*self.exps[:index], *self.exps[index+1:])))
 
-	@print_return
+	@traced
 	def select(self, name, index):
 		if isinstance(index, slice):
 			return Product(*self.exps[index]), Product(*self.exps[:index.start or 0], Var(name), *self.exps[index.stop:])
 		if isinstance(index, int):
 			return self.exps[index], Product(*self.exps[:index], Var(name), *self.exps[index+1:])
-		print(index, 'is not an int or a slice')
 		raise TypeError(f'{index!r} is not an int or a slice')
 
-	@print_return
-	def simplify(self):
-		exps = [exp.simplify() for exp in self.exps if exp not in (Const(1), Var('1'), Var('1.0'))]
+	def _simplify(self):
+		if len(self.exps) > 1:
+			for exp in self.exps:
+				if isinstance(exp, (Product, Neg)) or is_number(exp, 0) or is_number(exp, 1): break
+			else: return self  # nothing to flatten, drop or pull out, so no new node
+
+		exps = [exp for exp in self.exps if not is_number(exp, 1)]
 
 		products = (sub_exp for exp in exps if isinstance(exp, Product) for sub_exp in exp.exps)
 		not_products = (exp for exp in exps if not isinstance(exp, Product))
 
 		exps = [*products, *not_products]
 
-		if not exps: return Var('1')
+		if not exps: return one
 
 		if len(exps) == 1: return exps[0]
 
-		if Var('0') in exps: return Var('0')
+		if any(is_number(exp, 0) for exp in exps): return zero
 
 		neg = False
 
@@ -246,9 +856,11 @@ class Product(Expression):
 				exps[i] = exp.exp
 				neg = not neg
 
-		if neg: return Neg(Product(*exps).simplify())
+		if neg: return Neg(simplify_sequential(Product(*exps)))
 		return Product(*exps)
 
+	@traced
+	@memoized
 	def distribute(self):
 		for i, exp in enumerate(self.exps):
 			if isinstance(exp, Sum): break
@@ -263,96 +875,97 @@ class Product(Expression):
 
 		return Sum(*exps)
 
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		return Product(*(sub_exp if exp == find_exp else exp.substitute(find_exp, sub_exp) for exp in self.exps))
-
-	@print_return
-	def eval_consts(self):
-		exps = [exp.eval_consts() for exp in self.exps]
+	def _eval_consts(self):
 		const = 1
 		out_exps = []
-		for exp in exps:
-			if isinstance(exp, Var) and exp.is_const():
-				const *= float(exp.name)
-			elif isinstance(exp, Const):
+		for exp in self.exps:
+			if isinstance(exp, Const):
 				const *= exp.value
 			else:
 				out_exps.append(exp)
 
+		try: const = bounded(const)
+		except OverflowError: return self  # too large to keep exact or as a float
+
 		if not out_exps:
 			return Const(const)
 		return Product(Const(const), *out_exps)
 
+	def _evaluate(self, kids, np, bindings, dtype):
+		out = np.ones((), dtype)
+		for kid in kids: out = np.multiply(out, kid, dtype=dtype)
+		return out
+
 
 class Inv(Expression):  # Inverse
-	@print_return
+	__slots__ = ('exp',)
+
+	def __init__(self, exp):
+		self.exp = exp
+
+	@traced
 	def extract(self, rhs, index = 0):
 		if index != 0: raise IndexError('Inv only takes index 0')
 		return self.exp, Inv(rhs)
 
-	@print_return
+	@traced
 	def select(self, name, index = 0):
 		if index != 0: raise IndexError('Inv only takes index 0')
 		return self.exp, Inv(Var(name))
 
-	@print_return
-	def simplify(self):
-		exp = self.exp.simplify()
+	def _simplify(self):
+		exp = self.exp
 		if isinstance(exp, Inv): return exp.exp
-		if isinstance(exp, Neg): return Neg(Inv(exp.exp).simplify())
+		if isinstance(exp, Neg): return Neg(simplify_sequential(Inv(exp.exp)))
 		if isinstance(exp, Product):
-			return Product(*(Inv(exp) for exp in exp.exps)).simplify()
-
-		return Inv(exp)
+			return simplify_sequential(Product(*(Inv(exp) for exp in exp.exps)))
 
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		if self.exp == find_exp: return Inv(sub_exp)
-		return Inv(self.exp.substitute(find_exp, sub_exp))
+		return self
 
-	@print_return
-	def eval_consts(self):
-		post_const = self.exp.eval_consts()
+	def _eval_consts(self):
+		post_const = self.exp
 
-		if isinstance(post_const, Var) and post_const.is_const():
-			val = float(post_const.name)
-			if val == 0: return Inv(Const(0))
-			return Const(1/val)
 		if isinstance(post_const, Const):
-			if posr_const.val == 0: return Inv(Const(0))
-			return Const(1/post_const.value)
+			if post_const.value == 0: return Inv(Const(0))
+			return Const(divide(1, post_const.value))
+
+		return self
 
-		return Inv(post_const)
+	def _evaluate(self, kids, np, bindings, dtype):
+		return np.divide(1, kids[0], dtype=dtype)
 
 class Exp(Expression):  # Exponent
+	__slots__ = ('base', 'exp')
+
 	def __init__(self, base, exp):
-		super().__init__(exp)  # assigns self.exp = exp anyways. Teeny bit faster compared to assigning it outside again
 		self.base = base
+		self.exp = exp
 
-	def __contains__(self, exp):
-		return exp in (self.base, self.exp) or exp in self.base or exp in self.exp
+	def _args(self):
+		return self.base, self.exp
 
-	def __str__(self):
+	def _children(self):
+		return self.base, self.exp
+
+	def _str(self, kids):
+		base, exp = kids
 		if isinstance(self.base, (Sum, Neg, Product)):
-			base = f'({self.base})'
-		else: base = f'{self.base}'
+			base = f'({base})'
 
 		if isinstance(self.exp, (Sum, Neg, Product)):
-			exp = f'({self.exp})'
-		else: exp = f'{self.exp}'
+			exp = f'({exp})'
 
 		return f'{base}^{exp}'
-	
-	@print_return
+
+	@traced
 	def extract(self, rhs, index = 1):
 		if index == 0:
 			return self.base, Exp(rhs, Inv(self.exp))
 		if index == 1:
 			return self.exp, Log(self.base, rhs)
 		raise IndexError('Exp has only two valid indices: 0 and 1')
-	
-	@print_return
+
+	@traced
 	def select(self, rhs, index = 1):
 		if index == 0:
 			return self.base, Exp(Var(name), self.exp)
@@ -360,58 +973,41 @@ class Exp(Expression):  # Exponent
 			return self.exp, Exp(self.base, Var(name))
 		raise IndexError('Exp has only two valid indices: 0 and 1')
 
-	@print_return
-	def simplify(self):
-		exp = self.exp.simplify()
-		base = self.base.simplify()
-
+	def _simplify(self):
+		base = self.base
 		if isinstance(base, Exp):
-			return Exp(base.base, Product((base.exp, exp)))
-
-		return Exp(base, exp)
-
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		if self.base == find_exp: base = sub_exp
-		else: base = self.base.substitute(find_exp, sub_exp)
-
-		if self.exp == find_exp: exp = sub_exp
-		else: exp = self.exp.substitute(find_exp, sub_exp)
+			return Exp(base.base, Product(base.exp, self.exp)._simplify())
 
-		return Exp(base, exp)
+		return self
 
-	@print_return
-	def eval_consts(self):
-		base = self.base.eval_consts()
-		exp = self.exp.eval_consts()
+	def _eval_consts(self):
+		base = self.base
+		exp = self.exp
 
-		if isinstance(base, Var) and base.is_const():
-			base = float(base.name)
-		elif isinstance(base, Const):
-			base = base.value
-		else:
-			return Exp(base, exp)
+		if not isinstance(base, Const) or not isinstance(exp, Const):
+			return self
 
-		if isinstance(exp, Var) and exp.is_const():
-			exp = float(exp.name)
-		elif isinstance(exp, Const):
-			exp = exp.value
-		else:
-			return Exp(base, exp)
+		try: return Const(power(base.value, exp.value))
+		except (OverflowError, ZeroDivisionError): return self  # left as a power, like Inv(0)
 
-		return Const(base**exp)
+	def _evaluate(self, kids, np, bindings, dtype):
+		return np.power(*kids, dtype=dtype)
 
 
 class Log(Expression):
+	__slots__ = ('base', 'arg')
+
 	def __init__(self, base, arg):
-		super().__init__()
 		self.base = base
 		self.arg = arg
 
-	def __contains__(self, exp):
-		return exp in (self.base, self.arg) or exp in self.base or exp in self.arg
+	def _args(self):
+		return self.base, self.arg
 
-	@print_return
+	def _children(self):
+		return self.base, self.arg
+
+	@traced
 	def extract(self, rhs, index = 1):
 		if index == 0:
 			return self.base, Exp(self.arg, Inv(rhs))
@@ -419,7 +1015,7 @@ class Log(Expression):
 			return self.arg, Exp(self.base, rhs)
 		raise IndexError('Log has only two valid indices: 0 and 1')
 
-	@print_return
+	@traced
 	def select(self, name, index = 1):
 		if index == 0:
 			return self.base, Log(Var(name), self.arg)
@@ -427,302 +1023,675 @@ class Log(Expression):
 			return self.arg, Log(self.base, Var(name))
 		raise IndexError('Log has only two valid indices: 0 and 1')
 
-
-	@print_return
-	def simplify(self):
-		base = self.base.simplify()
-		arg = self.arg.simplify()
+	def _simplify(self):
+		base = self.base
+		arg = self.arg
 
 		if isinstance(arg, Exp):
-			return Product(arg.exp, Log(base, arg.base))
+			return Product(arg.exp, Log(base, arg.base)._simplify())._simplify()
 
 		if isinstance(base, Exp):
-			return Product(Log(base.base, arg), Inv(base.exp))
+			return Product(Log(base.base, arg)._simplify(), Inv(base.exp)._simplify())._simplify()
 
-		return Log(base, arg)
-
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		if self.arg == find_exp: arg = sub_exp
-		else: arg = self.arg.substitute(find_exp, sub_exp)
-
-		if self.base == find_exp: base = sub_exp
-		else: base = self.base.substitute(find_exp, sub_exp)
+		return self
 
-		return Log(arg, base)
+	def _evaluate(self, kids, np, bindings, dtype):
+		base, arg = kids
+		return np.divide(np.log(arg, dtype=dtype), np.log(base, dtype=dtype), dtype=dtype)
 
 
 class Var(Expression):
+	__slots__ = ('name',)
+
 	def __init__(self, name):
 		self.name = name
 
+	def _args(self):
+		return (self.name,)
+
+	def _children(self):
+		return ()
+
+	def _signature(self):
+		return var_bit(self.name)
+
+	def _rebuild(self, kids):
+		return self
+
 	def __contains__(self, exp):
 		return exp == self
-	
-	def __str__(self):
+
+	def _str(self, kids):
 		return self.name
 
-	def is_const(self):
-		if self.name.startswith('-'):
-			name = self.name[1:]
-		else:
-			name = self.name
-		return name.replace('.', '', 1).isdigit()
+	def is_const(self):  # numeric names only come from code that builds Vars directly
+		return literal_re.fullmatch(self.name) is not None
 
-	@print_return
+	@traced
 	def extract(self, rhs, index = 0):
 		if index != 0: raise IndexError('Variables only take index 0')
 		return self, rhs
 
-	@print_return
+	@traced
 	def select(self, name, index = 0):
 		if index != 0: raise IndexError('Variables only take index 0')
 		return self, Var(name)
 
-	@print_return
-	def simplify(self):
-		return self
-
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		return self
-
-	@print_return
-	def eval_consts(self):
+	def _eval_consts(self):
 		if self.is_const():
-			return Const(float(self.name))
+			return literal(self.name)
 		else:
 			return self
 
+	def _evaluate(self, kids, np, bindings, dtype):
+		if self.is_const(): return np.asarray(float(self.name), dtype)
+		if self.name not in bindings: raise KeyError(f'No binding for {self.name!r}')
+		return np.asarray(bindings[self.name], dtype)
+
 class Const(Expression):
+	__slots__ = ('value',)
+
 	def __init__(self, value):
 		self.value = value
 
+	def _args(self):
+		return (self.value,)
+
+	def _children(self):
+		return ()
+
+	def _rebuild(self, kids):
+		return self
+
 	def __contains__(self, exp):
 		return exp == self
 
-	def __str__(self):
+	def _str(self, kids):
 		return f'{self.value}'
 
-	@print_return
+	def _evaluate(self, kids, np, bindings, dtype):
+		return np.asarray(self.value, dtype)
+
+	@traced
 	def extract(self, rhs, index = 0):
 		if index != 0: raise IndexError('Constants only take index 0')
 		return self, rhs
 
-	@print_return
+	@traced
 	def select(self, name, index = 0):
 		if index != 0: raise IndexError('Constants only take index 0')
 		return self, Var(name)
 
-	@print_return
-	def simplify(self):
-		return self
-
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		return self
+leaf_types = Var, Const  # the nodes without children, see Expression.__eq__
 
 class Fn(Expression):
+	__slots__ = ('name', 'inv_name', 'arg')
+
 	def __init__(self, name, inv_name, arg):
 		self.name = name
 		self.inv_name = inv_name
 		self.arg = arg
 
-	def __contains__(self, exp):
-		return exp == self.arg or exp in self.arg
+	def _args(self):
+		return self.name, self.inv_name, self.arg
 
-	def __str__(self):
-		return f'{self.name}({self.arg})'
+	def _children(self):
+		return (self.arg,)
+
+	def _rebuild(self, kids):
+		arg, = kids
+		if arg is self.arg: return self
+		return Fn(self.name, self.inv_name, arg)
+
+	def _str(self, kids):
+		return f'{self.name}({kids[0]})'
+
+	def _evaluate(self, kids, np, bindings, dtype):
+		fn = functions.get(self.name)
+		if fn is None: raise KeyError(f'No function registered for {self.name!r}')
+		if isinstance(fn, str): return getattr(np, fn)(kids[0], dtype=dtype)
+		return np.asarray(fn(kids[0]), dtype)
 
 	def extract(self, rhs, index = 0):
 		if index != 0: raise IndexError(f'{name!r} only takes index 0')
 		return self.arg, Fn(self.inv_name, self.name, rhs)
 
-	def simplify(self):
+	def _simplify(self):
 		if isinstance(self.arg, Fn) and self.arg.inv_name == self.name and self.inv_name == self.arg.name:
 			return self.arg.arg
 
 		return self
 
+class Chain(Expression):
+	# what flatten() turns a nested chain of Sums (or Products) into: the plain terms of every
+	# level as children, and the layout of the levels around them. _simplify() joins the
+	# levels bottom-up exactly as simplifying them one at a time would, so term order
+	# is unchanged, but extends one list instead of rebuilding the chain once per level
+	__slots__ = ('cls', 'layout', 'exps')
 
-	@print_return
-	def substitute(self, find_exp, sub_exp):
-		if self.arg == find_exp: arg = sub_exp
-		else: arg = self.arg.substitute(find_exp, sub_exp)
+	def __init__(self, cls, layout, *exps):
+		self.cls = cls
+		self.layout = layout
+		self.exps = exps
 
-		return Fn(self.name, self.inv_name, arg)
+	def _args(self):
+		return (self.cls, self.layout, *self.exps)
+
+	def _children(self):
+		return self.exps
+
+	def _rebuild(self, kids):
+		for old, new in zip(self.exps, kids):
+			if old is not new: return Chain(self.cls, self.layout, *kids)
+		return self
+
+	def _simplify(self):
+		join = join_sums if self.cls is Sum else join_products
+		exps = self.exps
+		done = []  # per level, its simplified result: a Run or a node
+		for items in self.layout:
+			done.append(join([exps[i] if i >= 0 else done[~i] for i in items]))
+
+		out = done[-1]
+		return out.node() if isinstance(out, Run) else out
+
+# Numbers: numeric literals, typed as commands or in infix, are parsed once
+# into Consts. In 'int' mode (the default) whole numbers stay exact ints and the
+# rest are floats, 'fraction' keeps decimals exact as Fractions too, and 'float'
+# makes every literal a float. eval_consts() divides and raises exact values
+# exactly, so 1/3 is a Fraction in 'fraction' mode and a float otherwise.
+number_modes = ('int', 'fraction', 'float')
+number_mode = 'int'
+literal_re = re.compile(r'-?(?:\d+\.?\d*|\.\d+)')
+max_exact_bits = 8192  # exact results larger than this are taken in floats, str() refuses ints past 4300 digits
+
+def set_number_mode(mode = 'int'):
+	global number_mode
+	if mode not in number_modes: raise ValueError(f'Unknown number mode {mode!r}, expected one of {", ".join(number_modes)}')
+	previous, number_mode = number_mode, mode
+	if memo is not None and mode != previous: memo.clear()  # results folded in the old mode
+	return previous
+
+def literal(text):  # the Const for a numeric literal, or None
+	if literal_re.fullmatch(text) is None: return None
+	if number_mode == 'float': return Const(float(text))
+	if '.' not in text: return Const(int(text))
+	if number_mode == 'fraction': return Const(exact(Fraction(text)))
+	return Const(float(text))
+
+def exact(value):  # whole Fractions become ints
+	if isinstance(value, Fraction) and value.denominator == 1: return value.numerator
+	return value
+
+def is_exact(value):
+	return isinstance(value, (int, Fraction)) and not isinstance(value, bool)
+
+def exact_bits(value):
+	if isinstance(value, Fraction): return max(value.numerator.bit_length(), value.denominator.bit_length())
+	return value.bit_length()
+
+def bounded(value):  # exact values past max_exact_bits become floats, OverflowError if out of float range
+	if is_exact(value) and exact_bits(value) > max_exact_bits: return float(value)
+	return value
+
+def divide(a, b):
+	if number_mode == 'fraction' and is_exact(a) and is_exact(b): return exact(Fraction(a, b))
+	return a / b
+
+def power(base, exp):
+	if is_exact(base) and isinstance(exp, int) and not isinstance(exp, bool):
+		bits = exact_bits(base)
+		if bits > 1 and bits * abs(exp) > max_exact_bits: return float(base) ** exp
+		if exp < 0: return divide(1, base ** -exp)
+		return exact(base ** exp)
+	return base ** exp
+
+zero = Const(0)
+one = Const(1)
+
+def is_number(exp, value):  # the identity rules go by value, so 0.0 and Fraction(0) are zeros too
+	return exp.__class__ is Const and exp.value == value
+
+class Cell:  # one immutable stack entry; every version of a stack shares the cells below its top
+	__slots__ = ('value', 'below', 'size', 'bottom')
+
+	def __init__(self, value, below):
+		self.value = value
+		self.below = below
+		self.size = 1 if below is None else below.size + 1
+		self.bottom = value if below is None else below.bottom
+
+class Lazy_cell(Cell):  # a stack entry that is read from entries[index] (e.g. a Snapshot) each time it is asked for
+	__slots__ = ('entries', 'index')
+
+	def __init__(self, entries, index, below):
+		self.entries = entries
+		self.index = index
+		self.below = below
+		self.size = 1 if below is None else below.size + 1
+		self.bottom = entries[index] if below is None else below.bottom
+
+	@property
+	def value(self):
+		return self.entries[self.index]
+
+class Persistent_stack:
+	# list-like handle on a chain of Cells. Pushes and pops only move self.head,
+	# so any earlier head is still a complete, unchanged stack version. Work and
+	# new memory are proportional to how far from the top a change happens.
+	def __init__(self, values = (), head = None):
+		self.head = head
+		self.extend(values)
+
+	@classmethod
+	def lazy(cls, entries):  # a stack over entries that only reads the ones it is asked for
+		stack = cls()
+		for index in range(len(entries)): stack.head = Lazy_cell(entries, index, stack.head)
+		return stack
+
+	def __len__(self):
+		return 0 if self.head is None else self.head.size
+
+	def __iter__(self):  # bottom to top, like a list
+		values = []
+		cell = self.head
+		while cell is not None:
+			values.append(cell.value)
+			cell = cell.below
+		return reversed(values)
+
+	def __repr__(self):
+		return f'Persistent_stack({list(self)!r})'
+
+	def depth(self, index):  # number of cells above the one at index
+		size = len(self)
+		if index < 0: index += size
+		if not 0 <= index < size: raise IndexError('stack index out of range')
+		return size - 1 - index
+
+	def __getitem__(self, index):
+		if isinstance(index, slice): return list(self)[index]
+		if self.head is not None and index in (0, -self.head.size): return self.head.bottom
+
+		cell = self.head
+		for _ in range(self.depth(index)): cell = cell.below
+		return cell.value
+
+	def append(self, value):
+		self.head = Cell(value, self.head)
 
+	def extend(self, values):
+		for value in values: self.head = Cell(value, self.head)
+
+	def pop(self, index = -1):
+		if self.head is None: raise IndexError('pop from empty stack')
+		above = [self.pop() for _ in range(self.depth(index))]
+		value = self.head.value
+		self.head = self.head.below
+		self.extend(reversed(above))
+		return value
+
+	def insert(self, index, value):
+		size = len(self)
+		if index < 0: index = max(index + size, 0)
+		above = [self.pop() for _ in range(max(size - index, 0))]
+		self.append(value)
+		self.extend(reversed(above))
+
+class Discard:  # write sink for informational output nobody reads
+	def write(self, text): pass
+
+discard = Discard()
 
 class Command_processor:
-	def __init__(self):
-		self.stack = [Const(0)]
-	
+	# Commands are decoded once into (handler, args, command) ops, so a Program can
+	# replay a command sequence on many stacks without re-parsing any of it.
+	# Each op that changes the stack leaves the previous version in the undo
+	# history (at most `history` versions, None for no limit); since versions
+	# share cells, undo and redo just swap stack heads.
+	def __init__(self, history = 1000):
+		self.stack = Persistent_stack([Const(0)])
+		self.macros = {}
+		self.undo_stack = deque(maxlen=history)
+		self.redo_stack = []
+
 	def submit_command(self, command):
 		out = StringIO()
-
-		try:
-			if   command == '+':
-				r = self.stack.pop()
-				self.stack.append(self.stack.pop() + r)
-			elif command == '-':
-				r = self.stack.pop()
-				self.stack.append(self.stack.pop() - r)
-			elif command == '*':
-				r = self.stack.pop()
-				self.stack.append(self.stack.pop() * r)
-			elif command == '/':
-				r = self.stack.pop()
-				self.stack.append(self.stack.pop() / r)
-			elif command == '^':
-				r = self.stack.pop()
-				self.stack.append(self.stack.pop() ** r)
-
-			elif command == '_': self.stack.append(Neg(self.stack.pop()))
-			elif command == '.': self.stack.append(self.stack.pop().simplify())
-			elif command.startswith('.'):
-				split = command[1:].split()
-
-				if len(split) == 2:  # select index
-					print('select', file=out)
-					index, name = split
-					index = int(index)
-					self.stack.extend(
-						self.stack.pop().select(name, index)[::-1]
-					)
-
-				elif len(split) == 3:  # select slice
-					print('select slice', file=out)
-					start, stop, name = split
-					start = int(start)
-					stop = int(stop)
-					self.stack.extend(self.stack.pop().select(name, slice(start, stop))[::-1])
-				else:
-					raise ValueError('Invalid Command Format. Expected exactly 2 or 3 arguments')
-
-			elif command == ',': self.stack.append(self.stack.pop().distribute().simplify())
-			elif command.startswith(','):
-				exp = self.stack.pop()
-				if isinstance(exp, Neg):
-					neg = True
-					exp = exp.exp
-				else:
-					neg = False
-
-				if not isinstance(exp, Sum): raise TypeError('Can only factorise Sum types')
-				term = exp.exps[0]
-
-				if isinstance(term, Neg): term = term.exp
-
-				index = int(command[1:])
-
-				if isinstance(term, Product):
-					fac_exp = term.exps[index]
-				elif index != 0:
-					raise IndexError('Prime term can only be indexed with 0')
-				else:
-					fac_exp = term
-
-				if neg:
-					self.stack.append(Neg(exp.factor(fac_exp)).simplify())
-				else:
-					self.stack.append(exp.factor(fac_exp).simplify())
-
-			elif command == '$': self.stack.append(self.stack[-1])
-			elif command.startswith('$'): self.stack.append(self.stack[-int(command[1:])])
-
-			elif command.startswith('!'):
-				self.stack.append(Fn(*command[1:].split(), self.stack.pop()))
-
-			elif command == '\\':
-				self.stack.pop()
-
-			elif command == '/r':
-				print(repr(self.stack[-1]), file=out)
-			elif command == '/l':
-				print(file=out)
-				exp = self.stack[-1]
-				if isinstance(exp, (Neg, Inv)):
-					print(exp.__class__.__name__, end = ' ', file=out)
-					exp = exp.exp
-
-				print(exp.__class__.__name__, file=out)
-				for i, term in enumerate(exp.exps):
-					print(f'({i:2}) ', term, file=out)
-
-			elif command == '/ll':
-				exp = self.stack[-1]
-				if isinstance(exp, (Neg, Inv)):
-					print(exp.__class__.__name__, end = ' ', file=out)
-					exp = exp.exp
-
-				print(exp.__class__.__name__, file=out)
-				exp = exp.exps[0]
-
-				if isinstance(exp, (Neg, Inv)):
-					print(exp.__class__.__name__, end = ' ', file=out)
-					exp = exp.exp
-
-				print(exp.__class__.__name__, file=out)
-				for i, term in enumerate(exp.exps):
-					print(f'({i:2}) ', term, file=out)
-
-			elif command.startswith('/s'):
-				split = command[2:].split()
-				if len(split) == 0:  # swap
-					print('swap', file=out)
-					self.stack.append(self.stack.pop(-2))
-				elif len(split) == 1:  # substitute
-					print('sub', file=out)
-					name = split[0]
-					sub_exp = self.stack.pop()
-					exp = self.stack.pop()
-					self.stack.extend([exp.substitute(Var(name), sub_exp), sub_exp])
-				else:
-					raise ValueError('Invalid Command Format. Expected at most 1 argument')
-
-			elif command == '=':
-				self.stack.append(self.stack.pop().eval_consts())
-
-			elif command.startswith('=='):
-				name = command[2:]
-				self.stack.append(self.stack.pop().solve_for(Var(name), rhs=self.stack.pop()))
-
-			elif command.startswith('='):
-				index = command[1:]
-				if ' ' not in index: index = int(index)
-				else:
-					start, stop = index.split()
-					# prin, file=outt(start, stop)
-					index = slice(int(start), int(stop))
-
-				print(index, file=out)
-
-				self.stack.extend((self.stack.pop().extract(self.stack.pop(), index))[::-1])
-
-			else:
-				self.stack.append(Var(command))
+		try: op = self.decode(command)
 		except Exception as e:
 			print(f'Could not execute ({e.__class__.__name__})', file=out)
 			print(e, file=out)
+		else:
+			self.execute(op, out)
+		return out.getvalue()
+
+	@traced
+	def execute(self, op, out = discard):  # returns the error message, if the op failed
+		handler, args, _ = op
+		head = self.stack.head
+		error = None
+		try:
+			handler(self, out, *args)
+		except Exception as e:
+			error = f'Could not execute ({e.__class__.__name__})\n{e}'
+			print(error, file=out)
 			# raise e
-		
+
 		if not self.stack or self.stack[0] != Const(0):
 			self.stack.insert(0, Const(0))
 
-		return out.getvalue()
+		if self.stack.head is not head and handler not in (Command_processor.undo, Command_processor.redo):
+			self.undo_stack.append(head)
+			self.redo_stack.clear()
+
+		return error
+
+	def run(self, program, errors = None):
+		for op in program.ops:
+			error = self.execute(op)
+			if error is not None and errors is not None:
+				print(f'{op[2]!r}:', error.replace('\n', ' '), file=errors)
+		return self
+
+	def decode(self, command, macros = None):
+		op = Command_processor.exact.get(command)
+		if op is not None: return (*op, command)
+
+		for prefix, decoder in Command_processor.prefixed:
+			if command.startswith(prefix):
+				return (*decoder(command[len(prefix):], self.macros if macros is None else macros), command)
+
+		number = literal(command)
+		return Command_processor.push, (Var(command) if number is None else number,), command
+
+	def push(self, out, exp):
+		self.stack.append(exp)
+
+	def binary(self, out, operation):
+		r = self.stack.pop()
+		self.stack.append(operation(self.stack.pop(), r))
+
+	def unary(self, out, operation):
+		self.stack.append(operation(self.stack.pop()))
+
+	def select(self, out, name, index):
+		if isinstance(index, slice): print('select slice', file=out)
+		else: print('select', file=out)
+		self.stack.extend(self.stack.pop().select(name, index)[::-1])
+
+	def decode_select(args, macros):
+		split = args.split()
+
+		if len(split) == 2:  # select index
+			index, name = split
+			return Command_processor.select, (name, int(index))
+
+		if len(split) == 3:  # select slice
+			start, stop, name = split
+			return Command_processor.select, (name, slice(int(start), int(stop)))
+
+		raise ValueError('Invalid Command Format. Expected exactly 2 or 3 arguments')
+
+	def factor(self, out, index):
+		exp = self.stack.pop()
+		if isinstance(exp, Neg):
+			neg = True
+			exp = exp.exp
+		else:
+			neg = False
+
+		if not isinstance(exp, Sum): raise TypeError('Can only factorise Sum types')
+		term = exp.exps[0]
+
+		if isinstance(term, Neg): term = term.exp
+
+		if isinstance(term, Product):
+			fac_exp = term.exps[index]
+		elif index != 0:
+			raise IndexError('Prime term can only be indexed with 0')
+		else:
+			fac_exp = term
+
+		if neg:
+			self.stack.append(Neg(exp.factor(fac_exp)).simplify())
+		else:
+			self.stack.append(exp.factor(fac_exp).simplify())
+
+	def copy(self, out, index):
+		self.stack.append(self.stack[-index])
+
+	def function(self, out, names):
+		self.stack.append(Fn(*names, self.stack.pop()))
+
+	def drop(self, out):
+		self.stack.pop()
+
+	def undo(self, out, steps = 1):
+		if steps > len(self.undo_stack): raise IndexError(f'Only {len(self.undo_stack)} steps to undo')
+		for _ in range(steps):
+			self.redo_stack.append(self.stack.head)
+			self.stack.head = self.undo_stack.pop()
+
+	def redo(self, out, steps = 1):
+		if steps > len(self.redo_stack): raise IndexError(f'Only {len(self.redo_stack)} steps to redo')
+		for _ in range(steps):
+			self.undo_stack.append(self.stack.head)
+			self.stack.head = self.redo_stack.pop()
+
+	def print_repr(self, out):
+		print(repr(self.stack[-1]), file=out)
+
+	def list_terms(self, out, depth):
+		if depth == 1: print(file=out)
+		exp = self.stack[-1]
+		for level in range(depth):
+			if level: exp = exp.exps[0]
+
+			if isinstance(exp, (Neg, Inv)):
+				print(exp.__class__.__name__, end = ' ', file=out)
+				exp = exp.exp
+
+			print(exp.__class__.__name__, file=out)
+
+		for i, term in enumerate(exp.exps):
+			print(f'({i:2}) ', term, file=out)
+
+	def swap(self, out):
+		print('swap', file=out)
+		self.stack.append(self.stack.pop(-2))
+
+	def substitute(self, out, name):
+		print('sub', file=out)
+		sub_exp = self.stack.pop()
+		exp = self.stack.pop()
+		self.stack.extend([exp.substitute(Var(name), sub_exp), sub_exp])
+
+	def decode_swap_substitute(args, macros):
+		split = args.split()
+		if len(split) == 0: return Command_processor.swap, ()
+		if len(split) == 1: return Command_processor.substitute, (split[0],)
+		raise ValueError('Invalid Command Format. Expected at most 1 argument')
+
+	def solve_for(self, out, name):
+		self.stack.append(self.stack.pop().solve_for(Var(name), rhs=self.stack.pop()))
+
+	def extract(self, out, index):
+		print(index, file=out)
+		self.stack.extend((self.stack.pop().extract(self.stack.pop(), index))[::-1])
+
+	def decode_extract(index, macros):
+		if ' ' not in index: return Command_processor.extract, (int(index),)
+		start, stop = index.split()
+		return Command_processor.extract, (slice(int(start), int(stop)),)
+
+	def macro(self, out, ops):
+		for op in ops:
+			handler, args, _ = op
+			handler(self, out, *args)
+
+	def decode_macro(name, macros):
+		if name not in macros: raise KeyError(f'No macro named {name!r}')
+		return Command_processor.macro, (macros[name].ops,)
+
+	def save(self, out, path):
+		from snapshot import save
+		save(self.stack, path)
+		print('saved', len(self.stack), 'entries', file=out)
+
+	def load(self, out, path):  # replaces the whole stack, so '<' gets the old one back
+		# entries stay in the mapped file and are decoded when they are read,
+		# so opening a large session costs one small cell per entry
+		from snapshot import Snapshot
+		self.stack.head = Persistent_stack.lazy(Snapshot(path)).head
+
+	def decode_infix(text, macros):
+		from infix import parse
+		return Command_processor.push, (parse(text),)
+
+Command_processor.exact = {
+	'+': (Command_processor.binary, (Expression.__add__,)),
+	'-': (Command_processor.binary, (Expression.__sub__,)),
+	'*': (Command_processor.binary, (Expression.__mul__,)),
+	'/': (Command_processor.binary, (Expression.__truediv__,)),
+	'^': (Command_processor.binary, (Expression.__pow__,)),
+	'_': (Command_processor.unary, (Neg,)),
+	'.': (Command_processor.unary, (lambda exp: exp.simplify(),)),
+	',': (Command_processor.unary, (lambda exp: exp.distribute().simplify(),)),
+	'$': (Command_processor.copy, (1,)),
+	'\\': (Command_processor.drop, ()),
+	'<': (Command_processor.undo, ()),
+	'>': (Command_processor.redo, ()),
+	'/r': (Command_processor.print_repr, ()),
+	'/l': (Command_processor.list_terms, (1,)),
+	'/ll': (Command_processor.list_terms, (2,)),
+	'=': (Command_processor.unary, (lambda exp: exp.eval_consts(),)),
+}
+
+Command_processor.prefixed = (  # checked in order, after the exact matches
+	('.', Command_processor.decode_select),
+	(',', lambda index, macros: (Command_processor.factor, (int(index),))),
+	('$', lambda index, macros: (Command_processor.copy, (int(index),))),
+	("'", Command_processor.decode_infix),  # infix, e.g. 'a*(b+c)^2 - log(x)/y
+	('<', lambda steps, macros: (Command_processor.undo, (int(steps),))),
+	('>', lambda steps, macros: (Command_processor.redo, (int(steps),))),
+	('/w ', lambda path, macros: (Command_processor.save, (path.strip(),))),
+	('/o ', lambda path, macros: (Command_processor.load, (path.strip(),))),
+	('!', lambda names, macros: (Command_processor.function, (names.split(),))),
+	('/s', Command_processor.decode_swap_substitute),
+	('==', lambda name, macros: (Command_processor.solve_for, (name,))),
+	('=', Command_processor.decode_extract),
+	('@', Command_processor.decode_macro),
+)
+
+class Program:
+	# a command sequence decoded once; macros (name -> Program) are inlined as '@name'
+	def __init__(self, commands, macros = None):
+		decoder = Command_processor()
+		self.ops = []
+		for command in commands:
+			try: op = decoder.decode(command, macros or {})
+			except Exception as e: raise ValueError(f'Could not decode {command!r}: {e}') from e
+
+			if op[0] is Command_processor.macro: self.ops.extend(op[1][0])
+			else: self.ops.append(op)
+
+	def __len__(self):
+		return len(self.ops)
+
+	def run(self, command_processor = None, errors = None):
+		if command_processor is None: command_processor = Command_processor()
+		return command_processor.run(self, errors)
+
+def read_commands(lines):  # one command per line; blank lines and # comments are skipped
+	for line in lines:
+		line = line.strip()
+		if line and not line.startswith('#'): yield line
+
+def run_script(commands, command_processor = None, errors = None):
+	# feeds commands without redrawing the stack; failures are reported to errors, if given
+	if not isinstance(commands, Program): commands = Program(commands)
+	return commands.run(command_processor, errors)
 
 if __name__ == '__main__':
-	command_processor = Command_processor()
-	while 1:
-		print()
+	from reordering import Command_processor, Program, Trace, read_commands, run_script  # the copy infix builds nodes from
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description='Stack based equation reordering. Interactive when no script is given.')
+	parser.add_argument('script', nargs='?', help='file of commands, one per line ("-" for stdin)')
+	parser.add_argument('-i', '--inputs', help='file of infix expressions, one per line ("-" for stdin). The script is run once per expression, starting with it on the stack')
+	parser.add_argument('-e', '--emit', type=int, action='append', help='stack entry to print after each run, counted from the top (default: 1). Can be repeated')
+	parser.add_argument('-r', '--repr', action='store_true', help='print entries with repr() instead of str()')
+	parser.add_argument('-t', '--time', action='store_true', help='print a timing summary to stderr')
+	parser.add_argument('-p', '--profile', action='store_true', help='trace calls, times and node counts and print them to stderr')
+	args = parser.parse_args()
+
+	if args.script is None:
+		command_processor = Command_processor()
+		while 1:
+			print()
+
+			for i, exp in enumerate(command_processor.stack[1:], 1):
+				print(f'[{len(command_processor.stack) - i:3}]  ', exp)
+
+			command = ''
+			while not command:
+				command = input(': ').strip()
+
+			# raise e
+			output = command_processor.submit_command(command)
+			print(output, end='')
+
+	if args.script == '-' and args.inputs == '-': parser.error('script and inputs cannot both be read from stdin')
+
+	def open_lines(path):
+		return sys.stdin if path == '-' else open(path)
 
-		for i, exp in enumerate(command_processor.stack[1:], 1):
-			print(f'[{len(command_processor.stack) - i:3}]  ', exp)
+	emit = args.emit or [1]
+	fmt = repr if args.repr else str
 
-		command = ''
-		while not command:
-			command = input(': ').strip()
+	def emit_stack(command_processor):
+		for index in emit:
+			stack = command_processor.stack
+			print(fmt(stack[-index]) if 0 < index < len(stack) else '', flush=False)
+
+	profile = Trace().__enter__() if args.profile else None
+
+	start = perf_counter()
+	runs = commands = 0
+
+	with open_lines(args.script) as file:
+		try: script = Program(read_commands(file))
+		except ValueError as e: parser.error(e)
+
+		if args.inputs is None:
+			emit_stack(run_script(script, errors=sys.stderr))
+			runs, commands = 1, len(script)
+		else:
+			from infix import parse
+
+			with open_lines(args.inputs) as inputs:
+				for line_no, line in enumerate(inputs, 1):
+					line = line.strip()
+					if not line: continue
+
+					command_processor = Command_processor()
+					try: command_processor.stack.append(parse(line))
+					except ValueError as e:
+						print(f'input {line_no}: {e}', file=sys.stderr)
+						continue
+
+					emit_stack(run_script(script, command_processor, sys.stderr))
+					runs += 1
+					commands += len(script)
+
+	if args.time:
+		elapsed = perf_counter() - start
+		print(
+			f'{runs} runs, {commands} commands in {elapsed:.3f}s'
+			f' ({commands / elapsed if elapsed else 0:.0f} commands/s, {elapsed / max(runs, 1) * 1000:.3f}ms/run)',
+			file=sys.stderr,
+		)
 
-		# raise e
-		output = command_processor.submit_command(command)
-		print(output, end='')
+	if profile is not None:
+		profile.__exit__(None, None, None)
+		profile.report(sys.stderr)
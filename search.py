@@ -0,0 +1,142 @@
+import heapq
+from itertools import count
+from time import perf_counter
+
+from reordering import Command_processor, Persistent_stack, Expression, Sum, Product, Neg
+
+# Searches the command set for a short script that takes a start stack to one
+# satisfying a goal. States are Persistent_stack heads, so trying a command
+# on a state costs only the cells that command changes, and a transposition
+# table keyed on the stack contents drops every state reached before in as
+# few steps. Scripts come back as command lists that run_script() / batch
+# mode replay on the same start.
+
+def moves(stack):  # the default commands tried on a state, for the entry on top
+	top = stack[-1]
+	yield from ('.', ',', '=')
+	if len(stack) > 1:
+		for index in range(len(top._children())): yield f'={index}'
+	if len(stack) > 2: yield '/s'
+
+	exp = top.exp if isinstance(top, Neg) else top
+	if isinstance(exp, Sum) and exp.exps:
+		term = exp.exps[0]
+		if isinstance(term, Neg): term = term.exp
+		for index in range(len(term.exps) if isinstance(term, Product) else 1): yield f',{index}'
+
+def isolate(var):  # (goal, heuristic) for getting var alone on top of the stack
+	def heuristic(stack):  # levels above the shallowest var on top; each =N peels one off
+		level = [stack[-1]]
+		depth = 0
+		while level:
+			if var in level: return depth
+			level = [kid for node in level for kid in node._children() if kid._vars & var._vars == var._vars]
+			depth += 1
+		return depth
+
+	return (lambda stack: stack[-1] == var), heuristic
+
+def search(start, goal, heuristic = None, *, beam = None, moves = moves, node_limit = 10000, time_limit = None):
+	# start is an expression, a list of them (bottom first) or a Command_processor.
+	# goal is a predicate on the stack, or an expression the top entry should equal.
+	# A* on steps + heuristic(stack) by default, which with no heuristic finds the
+	# shortest script; with beam, only the best beam states by heuristic are kept
+	# at each depth. Returns the script, or None if the budget (states expanded,
+	# seconds) ran out first.
+	if isinstance(goal, Expression):
+		target = goal
+		goal = lambda stack: stack[-1] == target
+	if heuristic is None: heuristic = lambda stack: 0
+	deadline = None if time_limit is None else perf_counter() + time_limit
+
+	command_processor = Command_processor(history=0)
+	if isinstance(start, Command_processor): command_processor.stack.head = start.stack.head
+	else: command_processor.stack.extend([start] if isinstance(start, Expression) else start)
+
+	ops = {}
+	def step(head, command):  # the head after command, or None if it failed
+		op = ops.get(command)
+		if op is None: op = ops[command] = command_processor.decode(command)
+		command_processor.stack.head = head
+		if command_processor.execute(op) is not None: return None
+		return command_processor.stack.head
+
+	def script(path):  # paths are (command, parent path) links
+		out = []
+		while path is not None:
+			command, path = path
+			out.append(command)
+		return out[::-1]
+
+	root = command_processor.stack.head
+	seen = {tuple(Persistent_stack(head=root)): 0}
+	expanded = 0
+
+	if beam is None:
+		tiebreak = count()
+		frontier = [(heuristic(Persistent_stack(head=root)), next(tiebreak), 0, root, None)]
+		while frontier:
+			_, _, steps, head, path = heapq.heappop(frontier)
+			stack = Persistent_stack(head=head)
+			if goal(stack): return script(path)
+			if steps > seen.get(tuple(stack), steps): continue  # reached more cheaply since it was queued
+
+			expanded += 1
+			if expanded > node_limit or deadline is not None and perf_counter() > deadline: return None
+			for command in moves(stack):
+				new_head = step(head, command)
+				if new_head is None: continue
+				new_stack = Persistent_stack(head=new_head)
+				key = tuple(new_stack)
+				if seen.get(key, steps + 2) <= steps + 1: continue
+				seen[key] = steps + 1
+				heapq.heappush(frontier, (steps + 1 + heuristic(new_stack), next(tiebreak), steps + 1, new_head, (command, path)))
+		return None
+
+	if goal(Persistent_stack(head=root)): return []
+	level = [(root, None)]
+	depth = 0
+	while level:
+		depth += 1
+		children = []
+		for head, path in level:
+			expanded += 1
+			if expanded > node_limit or deadline is not None and perf_counter() > deadline: return None
+			for command in moves(Persistent_stack(head=head)):
+				new_head = step(head, command)
+				if new_head is None: continue
+				new_stack = Persistent_stack(head=new_head)
+				key = tuple(new_stack)
+				if key in seen: continue
+				seen[key] = depth
+				if goal(new_stack): return script((command, path))
+				children.append((heuristic(new_stack), new_head, (command, path)))
+
+		children.sort(key=lambda child: child[0])
+		level = [(head, path) for _, head, path in children[:beam]]
+	return None
+
+if __name__ == '__main__':
+	import sys
+	from argparse import ArgumentParser
+	from infix import parse
+
+	parser = ArgumentParser(description='Search for a command script, printed one command per line, that reaches a goal from an infix expression.')
+	parser.add_argument('start', help='infix expression to start from, e.g. "a*x + b - c" (read as "... = 0")')
+	goals = parser.add_mutually_exclusive_group(required=True)
+	goals.add_argument('-x', '--isolate', help='variable to get alone on top of the stack')
+	goals.add_argument('-g', '--target', help='infix expression the top of the stack should become')
+	parser.add_argument('-b', '--beam', type=int, help='beam width (default: A*)')
+	parser.add_argument('-n', '--nodes', type=int, default=10000, help='states to expand at most (default: 10000)')
+	parser.add_argument('-t', '--time', type=float, help='seconds to search at most')
+	args = parser.parse_args()
+
+	try: start = parse(args.start)
+	except ValueError as e: parser.error(e)
+
+	if args.isolate is not None: goal, heuristic = isolate(parse(args.isolate))
+	else: goal, heuristic = parse(args.target), None
+
+	found = search(start, goal, heuristic, beam=args.beam, node_limit=args.nodes, time_limit=args.time)
+	if found is None: sys.exit('No script found within the budget')
+	for command in found: print(command)
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from itertools import islice
+
+from reordering import Command_processor, walk
+from snapshot import dumps, loads
+
+# Hosts many Command_processor sessions in one process, over newline-delimited
+# JSON on a unix socket, TCP on localhost or stdin/stdout. Requests look like
+#   {"id": 1, "session": "alice", "command": "'a*(b+c)"}
+# and every response echoes id and session, with the command's output, the
+# error message if it failed, the stack depth and the top entries. A request
+# without a command just reports the stack, and {"session": ..., "close": true}
+# drops a session once the commands sent before it have run. Requests with
+# fields of the wrong type get an error response like any failed command.
+# Commands on one session run in order; different sessions interleave freely,
+# and '.', ',' and '=' on large entries run in a process pool so they don't
+# hold the others up.
+
+heavy = {Command_processor.exact[command][1] for command in '.,='}
+
+def run_unary(command, data):  # worker side: apply command to the snapshotted entry
+	command_processor = Command_processor(history=0)
+	command_processor.stack.extend(loads(data))
+	out = StringIO()
+	error = command_processor.execute(command_processor.decode(command), out)
+	return out.getvalue(), error, None if error else dumps([command_processor.stack[-1]])
+
+class Session:
+	def __init__(self):
+		self.command_processor = Command_processor()
+		self.lock = asyncio.Lock()
+
+class Server:
+	def __init__(self, processes = None, offload_size = 1000, summary = 10):
+		self.sessions = {}
+		self.executor = ProcessPoolExecutor(processes)
+		self.offload_size = offload_size  # nodes an entry needs before heavy commands on it are offloaded
+		self.summary = summary  # top entries sent back with each response
+
+	def close(self):
+		self.executor.shutdown()
+
+	async def submit(self, command_processor, command):  # (output, error message or None)
+		try: op = command_processor.decode(command)
+		except Exception as e:
+			error = f'Could not execute ({e.__class__.__name__})\n{e}'
+			return error + '\n', error
+
+		output = ''
+		stack = command_processor.stack
+		if (
+			op[0] is Command_processor.unary and op[1] in heavy and len(stack) > 1
+			and sum(1 for _ in islice(walk(stack[-1]), self.offload_size)) == self.offload_size
+		):
+			loop = asyncio.get_running_loop()
+			output, error, data = await loop.run_in_executor(self.executor, run_unary, command, dumps([stack[-1]]))
+			if error is not None: return output, error
+			result, = loads(data)
+			op = Command_processor.unary, (lambda exp: result,), command  # goes through execute() for the undo history
+
+		out = StringIO()
+		error = command_processor.execute(op, out)
+		return output + out.getvalue(), error
+
+	async def handle(self, request):
+		session_id = request.get('session', 'default')
+		command = request.get('command')
+		response = {'id': request.get('id'), 'session': session_id}
+		if not isinstance(session_id, str): return {**response, 'error': 'Invalid request: session must be a string'}
+		if command is not None and not isinstance(command, str): return {**response, 'error': 'Invalid request: command must be a string'}
+
+		if request.get('close'):  # after the commands already waiting on the session
+			session = self.sessions.get(session_id)
+			response['closed'] = False
+			if session is not None:
+				async with session.lock:
+					if self.sessions.get(session_id) is session:
+						del self.sessions[session_id]
+						response['closed'] = True
+			return response
+
+		while True:
+			session = self.sessions.get(session_id)
+			if session is None: session = self.sessions[session_id] = Session()
+			await session.lock.acquire()
+			if self.sessions.get(session_id) is session: break
+			session.lock.release()  # closed while this request waited, so it starts a new session
+
+		try:
+			if command:
+				response['output'], response['error'] = await self.submit(session.command_processor, command.strip())
+
+			stack = session.command_processor.stack
+			response['depth'] = len(stack) - 1
+			response['stack'] = [str(exp) for exp in stack[max(1, len(stack) - self.summary):]]
+		finally:
+			session.lock.release()
+		return response
+
+	async def connection(self, reader, writer):
+		tasks = set()
+
+		async def respond(request):
+			try: response = await self.handle(request)
+			except Exception as e:  # one bad request must not take the connection, and every session on it, down
+				response = {'id': request.get('id'), 'session': request.get('session', 'default'), 'error': f'Could not handle request ({e.__class__.__name__})\n{e}'}
+			writer.write(json.dumps(response).encode() + b'\n')
+			await writer.drain()
+
+		while line := await reader.readline():
+			if not line.strip(): continue
+			try:
+				request = json.loads(line)
+				if not isinstance(request, dict): raise ValueError('expected an object')
+			except ValueError as e:
+				writer.write(json.dumps({'id': None, 'error': f'Invalid request: {e}'}).encode() + b'\n')
+				continue
+
+			task = asyncio.create_task(respond(request))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+
+		await asyncio.gather(*tasks)
+		writer.close()
+
+line_limit = 2**24  # longest request line, in bytes
+
+class Blocking_writer:  # the part of StreamWriter that connection() uses, for stdout even when it is a file
+	def __init__(self, file):
+		self.file = file
+
+	def write(self, data):
+		self.file.write(data)
+		self.file.flush()
+
+	async def drain(self):
+		pass
+
+	def close(self):
+		self.file.flush()
+
+async def serve_stdio(server):
+	loop = asyncio.get_running_loop()
+	reader = asyncio.StreamReader(limit=line_limit)
+	await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+	writer = Blocking_writer(sys.stdout.buffer)
+	sys.stdout = sys.stderr  # stray prints must not end up in the response stream
+	await server.connection(reader, writer)
+
+async def serve(server, socket = None, port = None):
+	if socket is not None: listener = await asyncio.start_unix_server(server.connection, socket, limit=line_limit)
+	else: listener = await asyncio.start_server(server.connection, '127.0.0.1', port, limit=line_limit)
+	async with listener: await listener.serve_forever()
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description='Serve Command_processor sessions over newline-delimited JSON (stdin/stdout by default).')
+	transport = parser.add_mutually_exclusive_group()
+	transport.add_argument('-s', '--socket', help='unix socket path to listen on')
+	transport.add_argument('-p', '--port', type=int, help='TCP port to listen on, on 127.0.0.1')
+	parser.add_argument('-j', '--processes', type=int, help='worker processes for heavy commands (default: one per CPU)')
+	parser.add_argument('--offload-size', type=int, default=1000, help='nodes an entry needs before . , and = on it are offloaded (default: 1000)')
+	args = parser.parse_args()
+
+	server = Server(args.processes, args.offload_size)
+	try:
+		if args.socket is None and args.port is None: asyncio.run(serve_stdio(server))
+		else: asyncio.run(serve(server, args.socket, args.port))
+	except KeyboardInterrupt: pass
+	finally: server.close()
@@ -0,0 +1,236 @@
+import mmap
+import os
+import struct
+import tempfile
+from fractions import Fraction
+from io import BytesIO
+from weakref import WeakValueDictionary
+
+from reordering import Expression, Sum, Product, Neg, Inv, Exp, Log, Fn, Var, Const, fold
+
+# Binary snapshots of expression stacks. Layout, all little-endian:
+#   header   magic, version, then the offsets and counts of the tables below
+#   entries  u32 node id per stack entry, bottom first
+#   nodes    u64 offset of each node's record
+#   strings  u64 offset of each string in the string data, plus the end offset
+#   records  a tag byte, then u32 child/string ids (Sum and Product lead with a
+#            u32 count), or the packed value for a Const
+#   data     utf-8 Var and Fn names, and int and Fraction Consts as decimal text
+# Children are written before their parents and equal subtrees only once, so
+# a snapshot is never larger than the trees it holds, however much they share.
+# Snapshot reads it through mmap and only decodes the entries it is asked for.
+
+magic = b'EQSN'
+version = 1
+header = struct.Struct('<4sB3x8Q')
+
+SUM, PRODUCT, NEG, INV, EXP, LOG, VAR, FN, FLOAT, INT, COMPLEX, FRACTION = range(12)
+tags = {Sum: SUM, Product: PRODUCT, Neg: NEG, Inv: INV, Exp: EXP, Log: LOG}
+classes = {tag: cls for cls, tag in tags.items()}
+
+class Writer:
+	def __init__(self):
+		self.records = bytearray()
+		self.offsets = []
+		self.table = {}  # record bytes -> node id, so equal subtrees share one record
+		self.ids = {}  # id(node) -> node id, for subtrees already written
+		self.strings = {}
+
+	def string(self, text):
+		sid = self.strings.get(text)
+		if sid is None: sid = self.strings[text] = len(self.strings)
+		return sid
+
+	def node(self, node, kids):
+		if isinstance(node, (Sum, Product)):
+			record = struct.pack(f'<BI{len(kids)}I', tags[type(node)], len(kids), *kids)
+		elif type(node) in tags:
+			record = struct.pack(f'<B{len(kids)}I', tags[type(node)], *kids)
+		elif isinstance(node, Var):
+			record = struct.pack('<BI', VAR, self.string(node.name))
+		elif isinstance(node, Fn):
+			record = struct.pack('<B3I', FN, self.string(node.name), self.string(node.inv_name), *kids)
+		elif isinstance(node, Const):
+			value = node.value
+			if isinstance(value, bool) or not isinstance(value, (int, float, complex, Fraction)):
+				raise TypeError(f'Cannot snapshot a {type(value).__name__} constant')
+			if isinstance(value, int): record = struct.pack('<BI', INT, self.string(str(value)))
+			elif isinstance(value, Fraction): record = struct.pack('<BI', FRACTION, self.string(str(value)))
+			elif isinstance(value, float): record = struct.pack('<Bd', FLOAT, value)
+			else: record = struct.pack('<B2d', COMPLEX, value.real, value.imag)
+		else:
+			raise TypeError(f'{type(node).__name__} is not yet implemented')
+
+		nid = self.table.get(record)
+		if nid is None:
+			nid = self.table[record] = len(self.offsets)
+			self.offsets.append(len(self.records))
+			self.records += record
+		self.ids[id(node)] = nid
+		return nid
+
+	def add(self, exp: Expression):
+		return fold(exp, self.node, lambda node: self.ids.get(id(node)), share=False)
+
+	def write(self, file, entries):
+		data = bytearray()
+		string_offsets = []
+		for text in self.strings:  # dicts keep insertion order, which is sid order
+			string_offsets.append(len(data))
+			data += text.encode()
+		string_offsets.append(len(data))
+
+		tables = (
+			struct.pack(f'<{len(entries)}I', *entries),
+			struct.pack(f'<{len(self.offsets)}Q', *self.offsets),
+			struct.pack(f'<{len(string_offsets)}Q', *string_offsets),
+			self.records,
+		)
+		offset = header.size
+		offsets = []
+		for table in tables:
+			offsets.append(offset)
+			offset += len(table)
+
+		file.write(header.pack(
+			magic, version,
+			offsets[0], len(entries), offsets[1], len(self.offsets),
+			offsets[2], len(self.strings), offsets[3], offset,
+		))
+		for table in tables: file.write(table)
+		file.write(data)
+
+def dump(stack, file):  # stack is any sequence of expressions, bottom first
+	writer = Writer()
+	stack = list(stack)  # keeps every node alive while writer.ids refers to it by id
+	entries = [writer.add(exp) for exp in stack]
+	writer.write(file, entries)
+
+def save(stack, path):
+	# the stack may still be reading from a snapshot mapped from path (see Command_processor.load),
+	# so every entry is encoded first and the file is replaced, never truncated: the old
+	# mapping keeps its inode and stays readable, and a failed save leaves the old file whole
+	data = dumps(stack)
+	fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as file: file.write(data)
+		os.replace(temp, path)
+	except BaseException:
+		os.unlink(temp)
+		raise
+
+def dumps(stack):
+	file = BytesIO()
+	dump(stack, file)
+	return file.getvalue()
+
+def loads(data):
+	return Snapshot(data=data).decode_all()
+
+class Snapshot:
+	def __init__(self, path = None, *, data = None):  # a file to map, or a snapshot already in memory
+		if data is None:
+			with open(path, 'rb') as file:
+				data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.data = data
+
+		if len(self.data) < header.size: raise ValueError(f'{path or "data"!r} is not a snapshot')
+		(
+			file_magic, file_version,
+			self.entries_offset, self.entry_count, self.nodes_offset, self.node_count,
+			self.strings_offset, self.string_count, self.records_offset, self.data_offset,
+		) = header.unpack_from(self.data)
+		if file_magic != magic: raise ValueError(f'{path or "data"!r} is not a snapshot')
+		if file_version != version: raise ValueError(f'Unsupported snapshot version {file_version}')
+
+		self.cache = WeakValueDictionary()  # node id -> node, while anything still holds it
+
+	def close(self):
+		if isinstance(self.data, mmap.mmap): self.data.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __len__(self):
+		return self.entry_count
+
+	def __getitem__(self, index):
+		if isinstance(index, slice): return [self[i] for i in range(*index.indices(len(self)))]
+		if index < 0: index += len(self)
+		if not 0 <= index < len(self): raise IndexError('snapshot index out of range')
+		nid, = struct.unpack_from('<I', self.data, self.entries_offset + 4 * index)
+		return self.node(nid)
+
+	def __iter__(self):
+		for index in range(len(self)): yield self[index]
+
+	def string(self, sid):
+		start, end = struct.unpack_from('<2Q', self.data, self.strings_offset + 8 * sid)
+		return str(self.data[self.data_offset + start:self.data_offset + end], 'utf-8')
+
+	def record(self, nid):  # (tag, child ids, other arguments)
+		if not 0 <= nid < self.node_count: raise ValueError(f'Corrupt snapshot: no node {nid}')
+		offset, = struct.unpack_from('<Q', self.data, self.nodes_offset + 8 * nid)
+		offset += self.records_offset
+		tag = self.data[offset]
+		offset += 1
+
+		if tag in (SUM, PRODUCT):
+			count, = struct.unpack_from('<I', self.data, offset)
+			return tag, struct.unpack_from(f'<{count}I', self.data, offset + 4), ()
+		if tag in (NEG, INV): return tag, struct.unpack_from('<I', self.data, offset), ()
+		if tag in (EXP, LOG): return tag, struct.unpack_from('<2I', self.data, offset), ()
+		if tag == VAR: return tag, (), (self.string(*struct.unpack_from('<I', self.data, offset)),)
+		if tag == FN:
+			name, inv_name, arg = struct.unpack_from('<3I', self.data, offset)
+			return tag, (arg,), (self.string(name), self.string(inv_name))
+		if tag == FLOAT: return tag, (), struct.unpack_from('<d', self.data, offset)
+		if tag == INT: return tag, (), (int(self.string(*struct.unpack_from('<I', self.data, offset))),)
+		if tag == COMPLEX: return tag, (), (complex(*struct.unpack_from('<2d', self.data, offset)),)
+		if tag == FRACTION: return tag, (), (Fraction(self.string(*struct.unpack_from('<I', self.data, offset))),)
+		raise ValueError(f'Corrupt snapshot: unknown tag {tag}')
+
+	def node(self, root):
+		done = {}
+		todo = [root]
+		while todo:
+			nid = todo[-1]
+			if nid in done:
+				todo.pop()
+				continue
+			node = self.cache.get(nid)
+			if node is not None:
+				done[nid] = node
+				todo.pop()
+				continue
+
+			tag, kids, args = self.record(nid)
+			if any(kid >= nid for kid in kids): raise ValueError(f'Corrupt snapshot: node {nid} refers forward')
+			missing = [kid for kid in kids if kid not in done]
+			if missing:
+				todo.extend(missing)
+				continue
+
+			done[nid] = self.cache[nid] = build(tag, [done[kid] for kid in kids], args)
+			todo.pop()
+
+		return done[root]
+
+	def decode_all(self):  # every entry, decoding each record once in id order (children come first)
+		nodes = []
+		for nid in range(self.node_count):
+			tag, kids, args = self.record(nid)
+			if any(kid >= nid for kid in kids): raise ValueError(f'Corrupt snapshot: node {nid} refers forward')
+			nodes.append(build(tag, [nodes[kid] for kid in kids], args))
+		ids = struct.unpack_from(f'<{self.entry_count}I', self.data, self.entries_offset)
+		if any(nid >= self.node_count for nid in ids): raise ValueError('Corrupt snapshot: entry refers to a missing node')
+		return [nodes[nid] for nid in ids]
+
+def build(tag, kids, args):
+	if tag in classes: return classes[tag](*kids)
+	if tag == VAR: return Var(*args)
+	if tag == FN: return Fn(*args, *kids)
+	return Const(*args)
@@ -0,0 +1,8 @@
+from compiler import compile_expression, free_vars
+from reordering import Var
+
+def test_shared_subtrees_compile_once():
+	exp = Var('a') + Var('b')
+	for _ in range(40): exp = exp * exp  # 2**40 leaves as a tree, 42 nodes as a DAG
+	assert free_vars(exp) == ['a', 'b']
+	assert compile_expression(exp)(1.0, 0.0) == 1.0
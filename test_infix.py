@@ -0,0 +1,19 @@
+import math
+
+import pytest
+
+from infix import parse
+from reordering import Log, Sum, Var
+
+def test_commas_only_separate_call_arguments():
+	assert parse('log(b, x) + c') == Sum(Log(Var('b'), Var('x')), Var('c'))
+	for text in ('(a, b) + c', 'sin((a, b))', 'a, b'):
+		with pytest.raises(ValueError): parse(text)
+
+def test_calls_evaluate_without_extra_variables():
+	from compiler import compile_expression, free_vars
+	assert free_vars(parse('log(x)')) == ['x']
+	assert compile_expression(parse('log(x)'))(math.e) == 1.0
+
+	x, solved = parse('sqrt(x)').extract(Var('r'))
+	assert x == Var('x') and compile_expression(solved)(3.0) == 9.0
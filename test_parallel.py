@@ -0,0 +1,15 @@
+from parallel import set_parallel
+from reordering import Const, Exp, Neg, Product, Sum, Trace, Var, simplified, simplify_sequential
+
+def test_parent_does_no_per_term_work():
+	def build():
+		return Exp(Sum(*(Product(Var(f'x{i}'), Neg(Var(f'y{i}')), Const(1)) for i in range(3000))), Var('z'))
+
+	expected = simplify_sequential(build())
+	set_parallel(2, 1000)
+	try:
+		with Trace() as trace: out = build().simplify()
+	finally:
+		set_parallel(0)
+	assert out == expected and out._flags & simplified
+	assert trace.as_dict()['transform']['nodes'] == 2  # the Exp and its z, not the 3000 terms again
@@ -0,0 +1,15 @@
+from polynomial import Polynomial, canonicalize
+from reordering import Const, Neg, Sum, Var
+
+def test_long_and_deep_sums():
+	exp = Var('x0')
+	for i in range(1, 5000): exp = exp + Var(f'x{i % 50}')
+	assert Polynomial.from_expression(exp).terms[((Var('x0'), 1),)] == 100
+
+	exp = Sum(*(Var(f'x{i % 50}') for i in range(40000)), Neg(Var('x0')))
+	assert len(Polynomial.from_expression(exp).terms) == 50
+
+def test_shared_subtrees_are_not_modified():
+	shared = Var('a') + Var('b')
+	assert canonicalize(Sum(shared, shared, Neg(shared))) == canonicalize(shared)
+	assert canonicalize(shared * Const(2) + shared) == canonicalize(Const(3) * Var('a') + Const(3) * Var('b'))
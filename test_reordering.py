@@ -0,0 +1,149 @@
+import random
+
+from reordering import Const, Neg, Product, Sum, Var, one, run_script, simplified, zero
+
+def baseline_simplify(exp):  # the recursive Sum/Product/Neg rules simplify() started out with
+	if isinstance(exp, Sum):
+		exps = [baseline_simplify(kid) for kid in exp.exps if kid != zero]
+		exps = [*(term for kid in exps if isinstance(kid, Sum) for term in kid.exps), *(kid for kid in exps if not isinstance(kid, Sum))]
+		if not exps: return zero
+		if len(exps) == 1: return exps[0]
+		return Sum(*exps)
+
+	if isinstance(exp, Neg):
+		inner = baseline_simplify(exp.exp)
+		if isinstance(inner, Neg): return inner.exp
+		if isinstance(inner, Sum): return baseline_simplify(Sum(*(Neg(term) for term in inner.exps)))
+		return Neg(inner)
+
+	if isinstance(exp, Product):
+		exps = [baseline_simplify(kid) for kid in exp.exps if kid != one]
+		exps = [*(term for kid in exps if isinstance(kid, Product) for term in kid.exps), *(kid for kid in exps if not isinstance(kid, Product))]
+		if not exps: return one
+		if len(exps) == 1: return exps[0]
+		if zero in exps: return zero
+		neg = False
+		for i, kid in enumerate(exps):
+			if isinstance(kid, Neg):
+				exps[i] = kid.exp
+				neg = not neg
+		if neg: return Neg(baseline_simplify(Product(*exps)))
+		return Product(*exps)
+
+	return exp
+
+def random_tree(rng, depth):
+	r = rng.random()
+	if depth == 0 or r < 0.2: return Var(rng.choice('xyzw'))
+	if r < 0.35: return Neg(random_tree(rng, depth - 1))
+	cls = Sum if r < 0.7 else Product
+	return cls(*(random_tree(rng, depth - 1) for _ in range(rng.randint(1, 3))))
+
+def test_simplify_keeps_baseline_term_order():
+	assert str(Sum(Var('y'), Sum(Var('x'))).simplify()) == 'y + x'
+	assert str(Sum(Sum(Var('a'), Var('b')), Neg(Sum(Var('c'), Var('d')))).simplify()) == 'a + b - c - d'
+
+	rng = random.Random(0)
+	for _ in range(2000):
+		exp = random_tree(rng, 6)
+		assert repr(exp.simplify()) == repr(baseline_simplify(exp)), exp
+
+def test_simplify_flattens_deep_chains():
+	exp = Var('x0')
+	for i in range(1, 20000): exp = exp * Neg(Var(f'x{i}')) if i % 7 == 0 else exp * Var(f'x{i}')
+	out = exp.simplify()
+	assert isinstance(out, Neg) and [term.name for term in out.exp.exps] == [f'x{i}' for i in range(20000)]
+
+def test_resimplify_reaches_what_an_unmarked_copy_does():
+	once = Product(Neg(Const(0)), Neg(Var('z'))).simplify()
+	assert str(once) == '0 z'
+	assert not once._flags & simplified
+	assert once.simplify() == Product(Const(0), Var('z')).simplify() == Const(0)
+
+	assert str(run_script('0 _ z _ * . .'.split()).stack[-1]) == '0'
+
+def test_exact_powers_stay_printable():
+	out = run_script(["'(10^1000)^5", '=']).stack[-1]
+	assert str(out).endswith('^5')
+	assert str(run_script(["'2^4000", '=']).stack[-1]) == str(2 ** 4000)
+
+	out = run_script(["'10^1000 * 10^1000 * 10^1000 * 10^1000 * 10^1000", '=']).stack[-1]
+	assert isinstance(out, Product) and str(out)
+
+def test_nodes_pickle_and_copy():
+	import copy, pickle
+	exp = Sum(Var('x'), Neg(Product(Const(2), Var('y'))))
+	for out in (pickle.loads(pickle.dumps(exp)), copy.deepcopy(exp), copy.copy(exp)):
+		assert out == exp and out._vars == exp._vars
+
+def test_hash_is_computed_on_first_use():
+	exp = Sum(Var('x'), Product(Var('y'), Const(2)))
+	assert exp._hash is None and not hasattr(exp, '__dict__')
+	assert hash(exp) == hash(Sum(Var('x'), Product(Var('y'), Const(2))))
+	assert exp.exps[1]._hash is not None
+
+def test_load_keeps_entries_in_the_snapshot(tmp_path):
+	from reordering import Lazy_cell
+	path = tmp_path / 'session.snap'
+	run_script(['x', 'y', '+', "'a*b", f'/w {path}'])
+	processor = run_script([f'/o {path}'])
+	assert isinstance(processor.stack.head, Lazy_cell)
+	assert [str(exp) for exp in processor.stack] == ['0', 'x + y', 'a b']
+	assert str(run_script([f'/o {path}', '+', '.']).stack[-1]) == 'x + y + a b'
+
+def test_equality_keeps_number_types_apart_and_shared_pairs_once():
+	import pickle
+	assert Const(0) != Const(0.0) and Const(2) == Const(2)
+	assert str(Sum(Var('x'), Const(0.0)).simplify()) == 'x'
+
+	exp = Sum(Var('a'), Var('b'))
+	for _ in range(60): exp = Product(exp, exp)
+	copy = pickle.loads(pickle.dumps(exp))
+	assert copy is not exp and copy == exp
+	assert copy != Product(exp.exps[0], Product(exp.exps[0].exps[0], Sum(Var('a'), Var('c'))))
+
+def test_memo_skips_work_on_repeated_dot():
+	from fractions import Fraction
+	from reordering import Inv, Trace, set_memo, set_number_mode
+	script = ["'" + ' - '.join(f'x{i} y{i}' for i in range(2000)), '.']
+
+	memo = set_memo()
+	try:
+		first = run_script(script).stack[-1]
+		with Trace() as trace: again = run_script(script).stack[-1]
+		assert again == first and memo.hits
+		assert trace.as_dict()['transform']['nodes'] == 0  # the second '.' found the whole tree in the memo
+
+		def chain():  # simplified through a Chain, memoized under the Sum it came from
+			exp = Var('x0')
+			for i in range(1, 2000): exp = exp + Var(f'x{i}')
+			return exp
+		first = chain().simplify()
+		with Trace() as trace: assert chain().simplify() is first
+		assert trace.as_dict()['transform']['nodes'] == 0
+
+		assert Product(Const(2.0), Const(3.0)).eval_consts() == Const(6.0)
+		out = run_script(["'2*3", '=']).stack[-1]
+		assert out == Const(6) and type(out.value) is int
+
+		assert type(Inv(Const(3)).eval_consts().value) is float
+		previous = set_number_mode('fraction')
+		try: assert Inv(Const(3)).eval_consts() == Const(Fraction(1, 3))
+		finally: set_number_mode(previous)
+	finally:
+		set_memo(None)
+
+def test_save_over_the_loaded_snapshot(tmp_path):
+	path = tmp_path / 'session.snap'
+	run_script(['x', 'y', '+', "'a*b", f'/w {path}'])
+	processor = run_script([f'/o {path}', 'z', '*', f'/w {path}'])
+	assert [str(exp) for exp in processor.stack] == ['0', 'x + y', '(a b) z']
+	assert [str(exp) for exp in run_script([f'/o {path}']).stack] == ['0', 'x + y', '(a b) z']
+	assert [p.name for p in tmp_path.iterdir()] == ['session.snap']
+
+def test_var_bits_stay_bounded():
+	from reordering import var_bits
+	exps = [Var(f'name{i}') for i in range(10000)]
+	assert len(var_bits) <= 64
+	exp = Sum(*exps)
+	assert all(var in exp for var in exps[::997]) and Var('missing') not in exp
@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+from server import Server
+
+class Collecting_writer:
+	def __init__(self):
+		self.responses = []
+
+	def write(self, data):
+		self.responses.extend(json.loads(line) for line in data.decode().splitlines())
+
+	async def drain(self):
+		pass
+
+	def close(self):
+		pass
+
+def run(server, requests):
+	async def main():
+		reader = asyncio.StreamReader()
+		for request in requests: reader.feed_data(json.dumps(request).encode() + b'\n')
+		reader.feed_eof()
+		writer = Collecting_writer()
+		await server.connection(reader, writer)
+		return writer.responses
+	return asyncio.run(main())
+
+def test_close_waits_for_queued_commands_and_bad_fields_get_errors():
+	server = Server(processes=1, offload_size=1)  # so '.' goes to the pool and yields
+	try:
+		responses = run(server, [
+			{'id': 1, 'session': 's', 'command': "'a*b + a*c"},
+			{'id': 2, 'session': 's', 'command': '.'},
+			{'id': 3, 'session': 's', 'command': "'x + 0"},
+			{'id': 4, 'session': 's', 'command': '.'},
+			{'id': 5, 'session': 's', 'close': True},
+			{'id': 6, 'session': 's', 'command': 5},
+			{'id': 7, 'session': ['s'], 'command': 'x'},
+			{'id': 8, 'session': 't', 'command': 'y'},
+		])
+	finally:
+		server.close()
+
+	by_id = {response['id']: response for response in responses}
+	order = [response['id'] for response in responses]
+	assert order.index(5) > max(order.index(2), order.index(4))
+	assert by_id[5]['closed'] and by_id[4]['stack'] == ['a b + a c', 'x']
+	assert 'must be a string' in by_id[6]['error'] and 'must be a string' in by_id[7]['error']
+	assert by_id[8]['stack'] == ['y'] and 's' not in server.sessions